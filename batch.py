@@ -0,0 +1,156 @@
+import numpy as np
+import glob
+import itertools
+import json
+import os
+import traceback
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import redirect_stdout
+from datetime import datetime
+from yaml import safe_dump, safe_load
+from fractal import keep_grids, relative
+from parallel import default_workers
+from main import configs, run_config
+
+def find_config(name):
+    # a path, or the name of a file in /configs with or without its extension, like main.py takes
+    for path in [name, configs(name), configs(name + '.yaml')]:
+        if os.path.isfile(path):
+            return path
+    return None
+
+def sweep_values(values):
+    # a list of values, or {start, end, count} for count evenly spaced values from start to end
+    if isinstance(values, dict):
+        if set(values) != {'start', 'end', 'count'}:
+            raise ValueError(f'Sweep ranges need start, end and count, but had: {sorted(values)}')
+        return [value.item() for value in np.linspace(values['start'], values['end'], values['count'])]
+    if not isinstance(values, list):
+        return [values]
+    return values
+
+def _label(value):
+    if isinstance(value, float):
+        value = f'{value:.4g}'
+    return str(value).replace('/', '_').replace(' ', '')
+
+def expand_sweep(cfg, name):
+    # the jobs for a config with a sweep section: every combination of the values in it, on top of the rest of the
+    # config (and of the file named by config, if it has one)
+    cfg = dict(cfg)
+    sweep = cfg.pop('sweep')
+    base = {}
+    if 'config' in cfg:
+        start = cfg.pop('config')
+        path = find_config(start)
+        if path is None:
+            raise ValueError(f'Config to sweep from not found: {start}')
+        with open(path, 'r') as file:
+            base = safe_load(file)
+    base.update(cfg)
+    keys = list(sweep)
+    jobs = []
+    for values in itertools.product(*[sweep_values(sweep[key]) for key in keys]):
+        label = '_'.join(f'{key}={_label(value)}' for key, value in zip(keys, values))
+        jobs.append((f'{name} {label}', dict(base, **dict(zip(keys, values)))))
+    return jobs
+
+def collect_jobs(sources):
+    # (name, config) for every job in sources, which can be config files, folders of them, glob patterns or sweeps
+    paths = []
+    for source in sources:
+        if os.path.isdir(source):
+            paths += sorted(glob.glob(os.path.join(source, '*.yaml')))
+        elif find_config(source) is not None:
+            paths.append(find_config(source))
+        else:
+            matches = sorted(glob.glob(source))
+            if not matches:
+                raise ValueError(f'No configs found for {source}')
+            paths += matches
+    jobs = []
+    for path in paths:
+        name = os.path.splitext(os.path.basename(path))[0]
+        with open(path, 'r') as file:
+            cfg = safe_load(file)
+        if 'sweep' in cfg:
+            jobs += expand_sweep(cfg, name)
+        else:
+            jobs.append((name, cfg))
+    names = [name for name, _ in jobs]
+    return [(f'{ii:03} {name}' if names.count(name) > 1 else name, cfg) for ii, (name, cfg) in enumerate(jobs)]
+
+def run_job(name, cfg):
+    # runs one job (in a worker process, which keeps its imports, colormap tables and last grid between jobs),
+    # with its output going to log.txt in its folder. Failing doesn't raise, it's just reported
+    os.makedirs(cfg['folder'], exist_ok=True)
+    with open(os.path.join(cfg['folder'], 'config.yaml'), 'w') as file:
+        safe_dump(cfg, file)
+    start = datetime.now()
+    error = None
+    with open(os.path.join(cfg['folder'], 'log.txt'), 'w') as log, redirect_stdout(log):
+        try:
+            run_config(cfg, show=False)
+        except Exception as e:
+            error = ''.join(traceback.format_exception(e))
+            print(error)
+    return dict(name=name, status='done' if error is None else 'failed', error=error,
+                seconds=(datetime.now() - start).total_seconds(), started=start.isoformat(), folder=cfg['folder'],
+                outputs=sorted(os.listdir(cfg['folder'])))
+
+def write_manifest(path, manifest):
+    staging = path + '.tmp'
+    with open(staging, 'w') as file:
+        json.dump(manifest, file, indent=1, default=str)
+    os.replace(staging, path)
+
+def run_batch(jobs, folder, max_jobs=1):
+    # runs the jobs on up to max_jobs processes, each in its own subfolder of folder (unless its config says where),
+    # keeping folder/manifest.json up to date with how each one went
+    os.makedirs(folder, exist_ok=True)
+    path = os.path.join(folder, 'manifest.json')
+    start = datetime.now()
+    results = {name: dict(name=name, status='waiting') for name, _ in jobs}
+    manifest = dict(started=start.isoformat(), jobs=list(results.values()))
+    write_manifest(path, manifest)
+    with ProcessPoolExecutor(max_workers=max_jobs, initializer=keep_grids) as pool:
+        futures = {}
+        for name, cfg in jobs:
+            cfg = dict(cfg)
+            cfg.setdefault('folder', os.path.join(folder, name))
+            # the batch is already split between processes
+            cfg['workers'] = 1
+            futures[pool.submit(run_job, name, cfg)] = name
+        for future in as_completed(futures):
+            name = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                # the worker itself died (e.g. ran out of memory), not just the job
+                result = dict(name=name, status='failed', error=repr(e))
+            results[name].update(result)
+            print(f'{name}: {result["status"]}' + (f' in {result["seconds"]:.1f}s' if 'seconds' in result else ''))
+            manifest['jobs'] = list(results.values())
+            write_manifest(path, manifest)
+    manifest['seconds'] = (datetime.now() - start).total_seconds()
+    manifest['failed'] = sum(result['status'] == 'failed' for result in results.values())
+    write_manifest(path, manifest)
+    return manifest
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run many configs, or sweeps over config values, in one go.')
+    parser.add_argument('SOURCES', nargs='+', help='config files (or names in /configs), folders of them, glob patterns, '
+                                                   'or sweep files (see README)')
+    parser.add_argument('--jobs', '-j', default='auto', help='how many configs to run at once, or auto for one per core')
+    parser.add_argument('--folder', '-f', default=None, help='output folder, with a subfolder for each job')
+    args = parser.parse_args()
+    jobs = collect_jobs(args.SOURCES)
+    max_jobs = default_workers() if args.jobs == 'auto' else int(args.jobs)
+    folder = args.folder
+    if folder is None:
+        folder = relative('output', datetime.now().strftime('%Y-%m-%d-%H%M%S') + ' batch')
+    print(f'Running {len(jobs)} job{"s" if len(jobs) != 1 else ""} on {min(max_jobs, len(jobs))} process'
+          f'{"es" if min(max_jobs, len(jobs)) != 1 else ""}, output in {folder}')
+    manifest = run_batch(jobs, folder, max_jobs=max_jobs)
+    print(f'Finished in {manifest["seconds"]:.1f}s, {manifest["failed"]} failed')
@@ -0,0 +1,208 @@
+import numpy as np
+import glob
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+import argparse
+from contextlib import redirect_stdout
+from datetime import datetime
+from yaml import safe_load
+from fractal import relative
+from main import run_config
+
+PHASES = ['init', 'iterate', 'show', 'image', 'gif']
+# run types that don't render anything themselves
+SKIPPED_RUN_TYPES = ['reanimate', 'resume']
+# changes smaller than this many seconds are noise, whatever the ratio
+MIN_SECONDS = 0.02
+
+class PhaseTimer:
+    # a hook (see Instruments) adding up the time, memory peak and pixel-iterations of each phase of a run
+    def __init__(self):
+        self.seconds = dict.fromkeys(PHASES, 0.0)
+        self.peak = dict.fromkeys(PHASES, 0)
+        self.pixel_iterations = 0
+
+    def __call__(self, event):
+        if event['event'] == 'step':
+            self.pixel_iterations += event['iterated']
+        elif event['event'] == 'phase' and event['phase'] in self.seconds:
+            self.seconds[event['phase']] += event['seconds']
+            self.peak[event['phase']] = max(self.peak[event['phase']], event['peak_bytes'] or 0)
+
+def config_frames(cfg):
+    if 'frames' in cfg:
+        return cfg['frames']
+    if 'fps' in cfg and 'seconds' in cfg:
+        return cfg['fps'] * cfg['seconds']
+    return 1
+
+def scale_config(cfg, pixels, frames, steps):
+    # a smaller version of cfg: at most pixels on its longer side (keeping its shape), at most frames frames and at
+    # most steps steps per frame, rendered in this process without caches or checkpoints so every run does the same work
+    cfg = dict(cfg)
+    xpixels = cfg.pop('xpixels', cfg.get('pixels', 1024))
+    ypixels = cfg.pop('ypixels', cfg.get('pixels', 1024))
+    cfg.pop('pixels', None)
+    scale = min(1, pixels / max(xpixels, ypixels))
+    cfg['xpixels'] = max(1, round(xpixels * scale))
+    cfg['ypixels'] = max(1, round(ypixels * scale))
+    cfg['frames'] = min(config_frames(cfg), frames)
+    cfg.pop('fps', None)
+    for key in ['steps', 'steps_start', 'steps_end']:
+        if key in cfg:
+            cfg[key] = min(cfg[key], steps)
+    for key in ['cache', 'checkpoint', 'checkpoint_interval', 'max_memory', 'folder']:
+        cfg.pop(key, None)
+    cfg['workers'] = 1
+    return cfg
+
+def describe(cfg):
+    # which of the cases the engine handles differently this config is
+    power = np.linspace(cfg['power_start'], cfg['power_end'], 2) if 'power_start' in cfg else cfg.get('power', 2)
+    if cfg.get('run_type', 'julia') != 'julia':
+        param = 'grid'
+    elif any(key.startswith('param') and key.endswith(('_start', '_end')) for key in cfg):
+        param = 'array'
+    else:
+        param = 'scalar'
+    return dict(run_type=cfg.get('run_type', 'julia'), power='array' if 'power_start' in cfg else 'scalar',
+                integer_power=bool(np.all(np.asarray(power) == np.round(power))), param=param,
+                frames=cfg['frames'], pixels=cfg['xpixels'] * cfg['ypixels'])
+
+def run_once(cfg):
+    timer = PhaseTimer()
+    with tempfile.TemporaryDirectory() as folder, open(os.devnull, 'w') as null, redirect_stdout(null):
+        tracemalloc.reset_peak()
+        start = time.perf_counter()
+        run_config(dict(cfg, folder=folder), show=False, hooks=[timer])
+        seconds = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1]
+    return timer, seconds, max(peak, *timer.peak.values())
+
+def benchmark_config(cfg, repeat):
+    # the fastest of repeat runs for each phase, which is the least affected by whatever else the machine is doing
+    runs = [run_once(cfg) for _ in range(repeat)]
+    phases = {phase: dict(seconds=min(timer.seconds[phase] for timer, _, _ in runs),
+                          peak_bytes=max(timer.peak[phase] for timer, _, _ in runs))
+              for phase in PHASES}
+    pixel_iterations = runs[0][0].pixel_iterations
+    iterate_seconds = phases['iterate']['seconds']
+    return dict(case=describe(cfg), phases=phases, seconds=min(seconds for _, seconds, _ in runs),
+                peak_bytes=max(peak for _, _, peak in runs), pixel_iterations=pixel_iterations,
+                pixel_iterations_per_second=pixel_iterations / iterate_seconds if iterate_seconds > 0 else None)
+
+def collect_configs(patterns):
+    # (name, config) for every config that renders something, skipping sweeps and run types like reanimate
+    paths = sorted({path for pattern in patterns for path in glob.glob(pattern)})
+    if not paths:
+        raise ValueError(f'No configs found for {" ".join(patterns)}')
+    found = []
+    for path in paths:
+        with open(path, 'r') as file:
+            cfg = safe_load(file)
+        if not isinstance(cfg, dict) or 'sweep' in cfg or cfg.get('run_type', 'julia') in SKIPPED_RUN_TYPES:
+            continue
+        found.append((os.path.splitext(os.path.basename(path))[0], cfg))
+    return found
+
+def run_benchmarks(configs, pixels=128, frames=8, steps=1000, repeat=5):
+    results = dict(started=datetime.now().isoformat(), pixels=pixels, frames=frames, steps=steps, repeat=repeat,
+                   python=platform.python_version(), numpy=np.__version__, machine=platform.machine(),
+                   processor=platform.processor(), cpus=os.cpu_count(), configs={})
+    tracemalloc.start()
+    try:
+        for name, cfg in configs:
+            cfg = scale_config(cfg, pixels, frames, steps)
+            try:
+                result = benchmark_config(cfg, repeat)
+            except Exception as e:
+                result = dict(case=describe(cfg), error=repr(e))
+                print(f'{name}: failed ({e!r})')
+            else:
+                print(f'{name}: {result["seconds"]:.3f}s, '
+                      + ', '.join(f'{phase} {result["phases"][phase]["seconds"]:.3f}s' for phase in PHASES)
+                      + (f', {result["pixel_iterations_per_second"] / 1e6:.1f}M pixel-iterations/s'
+                         if result['pixel_iterations_per_second'] else '')
+                      + f', peak {result["peak_bytes"] / 2 ** 20:.1f}MB')
+            results['configs'][name] = result
+    finally:
+        tracemalloc.stop()
+    return results
+
+def compare(results, baseline, threshold):
+    # regressions from baseline to results: any phase or whole run more than threshold (as a fraction) slower,
+    # or using more than threshold more memory at its peak
+    regressions = []
+    for name, result in results['configs'].items():
+        old = baseline['configs'].get(name)
+        if old is None or 'error' in old:
+            continue
+        if 'error' in result:
+            regressions.append(f'{name}: failed ({result["error"]})')
+            continue
+        if result['case'] != old['case']:
+            print(f'{name}: not the same case as in the baseline, so not compared')
+            continue
+        timings = [('total', result['seconds'], old['seconds'])]
+        timings += [(phase, result['phases'][phase]['seconds'], old['phases'][phase]['seconds']) for phase in PHASES]
+        for label, new_seconds, old_seconds in timings:
+            if new_seconds - old_seconds > MIN_SECONDS and new_seconds > old_seconds * (1 + threshold):
+                regressions.append(f'{name} {label}: {old_seconds:.3f}s -> {new_seconds:.3f}s')
+        if result['peak_bytes'] > old['peak_bytes'] * (1 + threshold):
+            regressions.append(f'{name} peak memory: {old["peak_bytes"] / 2 ** 20:.1f}MB -> '
+                               f'{result["peak_bytes"] / 2 ** 20:.1f}MB')
+        print(f'{name}: {result["seconds"] / old["seconds"]:.2f}x the baseline time')
+    return regressions
+
+def write_results(path, results):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    staging = path + '.tmp'
+    with open(staging, 'w') as file:
+        json.dump(results, file, indent=1, default=str)
+    os.replace(staging, path)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Time each phase of rendering the configs, and compare against a '
+                                                 'baseline.')
+    parser.add_argument('CONFIGS', nargs='*', default=[relative('configs', '*.yaml')],
+                        help='config files or glob patterns (all of /configs by default)')
+    parser.add_argument('--pixels', '-p', type=int, default=128, help='size of the longer side of each render')
+    parser.add_argument('--frames', type=int, default=8, help='most frames to render for an animation')
+    parser.add_argument('--steps', type=int, default=1000, help='most steps to run each frame for')
+    parser.add_argument('--repeat', '-n', type=int, default=5, help='runs of each config, keeping the fastest')
+    parser.add_argument('--baseline', '-b', default=relative('benchmarks', 'baseline.json'),
+                        help='results to compare against')
+    parser.add_argument('--threshold', '-t', type=float, default=0.2,
+                        help='fraction slower (or more memory) than the baseline that counts as a regression')
+    parser.add_argument('--save-baseline', action='store_true', help='save these results as the new baseline')
+    args = parser.parse_args()
+    results = run_benchmarks(collect_configs(args.CONFIGS), pixels=args.pixels, frames=args.frames,
+                             steps=args.steps, repeat=args.repeat)
+    path = relative('benchmarks', datetime.now().strftime('%Y-%m-%d-%H%M%S') + '.json')
+    write_results(path, results)
+    print(f'Results saved to {path}')
+    if args.save_baseline:
+        write_results(args.baseline, results)
+        print(f'Saved as the baseline ({args.baseline})')
+    elif not os.path.exists(args.baseline):
+        print(f'No baseline at {args.baseline} to compare against (save one with --save-baseline)')
+    else:
+        with open(args.baseline, 'r') as file:
+            baseline = json.load(file)
+        size = ['pixels', 'frames', 'steps']
+        if [baseline.get(key) for key in size] != [results[key] for key in size]:
+            print('The baseline was run at a different size, so the results can\'t be compared')
+            sys.exit(1)
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(f'{len(regressions)} regression{"s" if len(regressions) != 1 else ""} '
+                  f'(more than {args.threshold:.0%} worse than the baseline):')
+            for regression in regressions:
+                print(f'  {regression}')
+            sys.exit(1)
+        print('No regressions')
@@ -0,0 +1,91 @@
+import numpy as np
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+# bump this whenever a change to the engines changes their results, so old entries stop matching
+CACHE_VERSION = 2
+
+def _feed(digest, value):
+    if isinstance(value, np.ndarray):
+        digest.update(f'array {value.dtype.str} {value.shape}'.encode())
+        digest.update(np.ascontiguousarray(value).tobytes())
+    elif isinstance(value, dict):
+        digest.update(f'dict {len(value)}'.encode())
+        for key in sorted(value):
+            _feed(digest, key)
+            _feed(digest, value[key])
+    elif isinstance(value, (list, tuple)):
+        digest.update(f'list {len(value)}'.encode())
+        for item in value:
+            _feed(digest, item)
+    else:
+        digest.update(f'{type(value).__name__} {value!r}'.encode())
+
+def cache_key(inputs):
+    # inputs should hold everything the iterations and values depend on (the resolved per-frame arrays rather
+    # than the config keys they came from, so defaults and equivalent configs get the same key)
+    digest = hashlib.sha256()
+    _feed(digest, CACHE_VERSION)
+    _feed(digest, inputs)
+    return digest.hexdigest()
+
+def _entry_size(path):
+    return sum(entry.stat().st_size for entry in os.scandir(path) if entry.is_file())
+
+def load_cached(folder, key, fractal):
+    # fills in fractal's results from the cache and returns True, or returns False if they aren't there.
+    # the arrays are memory-mapped copy-on-write, so showing them doesn't touch the cache
+    path = os.path.join(folder, key)
+    try:
+        with open(os.path.join(path, 'meta.json'), 'r') as file:
+            meta = json.load(file)
+        array = np.load(os.path.join(path, 'array.npy'), mmap_mode='c')
+        iterations = np.load(os.path.join(path, 'iterations.npy'), mmap_mode='c')
+    except (OSError, ValueError):
+        return False
+    if array.shape != fractal.array.shape or iterations.shape != fractal.iterations.shape:
+        return False
+    os.utime(path)  # marks it as recently used
+    fractal.array = array
+    fractal.iterations = iterations
+    fractal.total_steps = meta['total_steps']
+    fractal.to_show = fractal.iterations
+    return True
+
+def store_cached(folder, key, fractal, max_size):
+    # max_size is in megabytes
+    os.makedirs(folder, exist_ok=True)
+    path = os.path.join(folder, key)
+    if os.path.exists(path):
+        return
+    # written somewhere else first and then moved into place, so an interrupted run can't leave half an entry
+    staging = tempfile.mkdtemp(dir=folder, prefix='.tmp')
+    try:
+        np.save(os.path.join(staging, 'array.npy'), fractal.array)
+        np.save(os.path.join(staging, 'iterations.npy'), fractal.iterations)
+        with open(os.path.join(staging, 'meta.json'), 'w') as file:
+            json.dump({'total_steps': int(fractal.total_steps)}, file)
+        os.replace(staging, path)
+    except OSError:
+        shutil.rmtree(staging, ignore_errors=True)
+        raise
+    evict(folder, max_size, keep=key)
+
+def evict(folder, max_size, keep=None):
+    # deletes the least recently used entries until the cache fits in max_size megabytes
+    entries = []
+    for entry in os.scandir(folder):
+        if entry.is_dir() and not entry.name.startswith('.'):
+            entries.append((entry.stat().st_mtime, _entry_size(entry.path), entry.name))
+    entries.sort()
+    total = sum(size for _, size, _ in entries)
+    for _, size, name in entries:
+        if total <= max_size * 2 ** 20:
+            break
+        if name == keep:
+            continue
+        shutil.rmtree(os.path.join(folder, name), ignore_errors=True)
+        total -= size
@@ -0,0 +1,83 @@
+import numpy as np
+import json
+import os
+import shutil
+
+CHECKPOINT_FOLDER = 'checkpoint'
+
+def _meta_path(folder):
+    return os.path.join(folder, CHECKPOINT_FOLDER, 'checkpoint.json')
+
+def read_checkpoints(folder):
+    # the checkpoint info for an output folder (the config it was run with, and the state saved for each batch of
+    # frames), or None if it doesn't have any
+    try:
+        with open(_meta_path(folder), 'r') as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return None
+
+def _save_array(path, values):
+    with open(path, 'wb') as file:
+        np.save(file, values)
+        file.flush()
+        os.fsync(file.fileno())
+
+def save_checkpoint(folder, cfg, first, fractal, done):
+    # saves fractal's state for the batch of frames starting at first, which has had done steps per frame.
+    # the arrays go in a new folder, and only once they're written does checkpoint.json get swapped (atomically)
+    # to point at them, so a run killed partway through saving still has its previous checkpoint
+    base = os.path.join(folder, CHECKPOINT_FOLDER)
+    os.makedirs(base, exist_ok=True)
+    meta = read_checkpoints(folder) or {'batches': {}}
+    meta['config'] = cfg
+    previous = meta['batches'].get(str(first))
+    generation = previous['generation'] + 1 if previous is not None else 0
+    name = f'batch{first:05}_{generation}'
+    path = os.path.join(base, name)
+    shutil.rmtree(path, ignore_errors=True)  # left over from a save that never finished
+    os.makedirs(path)
+    _save_array(os.path.join(path, 'array.npy'), fractal.array)
+    _save_array(os.path.join(path, 'iterations.npy'), fractal.iterations)
+    meta['batches'][str(first)] = {'generation': generation, 'folder': name, 'total_steps': int(fractal.total_steps),
+                                   'steps': [int(steps) for steps in done]}
+    staging = _meta_path(folder) + '.tmp'
+    with open(staging, 'w') as file:
+        json.dump(meta, file, indent=1, default=str)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(staging, _meta_path(folder))
+    if previous is not None:
+        shutil.rmtree(os.path.join(base, previous['folder']), ignore_errors=True)
+
+def load_checkpoint(folder, first, fractal):
+    # loads the state saved for the batch of frames starting at first into fractal (memory-mapped copy-on-write,
+    # so the checkpoint itself isn't changed), and returns how many steps each frame has already had.
+    # returns None if the batch doesn't have a checkpoint (e.g. the run stopped before getting to it)
+    meta = read_checkpoints(folder)
+    batch = meta['batches'].get(str(first)) if meta is not None else None
+    if batch is None:
+        return None
+    path = os.path.join(folder, CHECKPOINT_FOLDER, batch['folder'])
+    array = np.load(os.path.join(path, 'array.npy'), mmap_mode='c')
+    iterations = np.load(os.path.join(path, 'iterations.npy'), mmap_mode='c')
+    if array.shape != fractal.array.shape:
+        raise ValueError(f'Checkpoint has shape {array.shape}, but the resumed run has shape {fractal.array.shape}')
+    fractal.array = array
+    fractal.iterations = iterations
+    fractal.total_steps = batch['total_steps']
+    fractal.to_show = fractal.iterations
+    return np.asarray(batch['steps'])
+
+def iterate_in_chunks(fractal, method, steps, interval, save, log_interval=-1, **kwargs):
+    # runs fractal's iterate method (one that can carry on from where it stopped, i.e. not iterate_subdivide) for
+    # steps (fixed or per frame), interval steps at a time, calling save with the steps each frame has had so far
+    # after every chunk. The results are the same as running all the steps at once
+    steps = np.broadcast_to(steps, fractal.array.shape[:1])
+    done = np.zeros(steps.shape, dtype=int)
+    while (done < steps).any():
+        chunk = np.minimum(steps - done, interval)
+        getattr(fractal, method)(int(chunk[0]) if np.all(chunk == chunk[0]) else chunk,
+                                 log_interval=log_interval, **kwargs)
+        done += chunk
+        save(done)
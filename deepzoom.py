@@ -0,0 +1,177 @@
+import numpy as np
+import re
+from decimal import Decimal, localcontext
+from math import comb, ceil, log10
+from fractal import Fractal, phase
+
+# digits of precision beyond what's needed to tell neighboring pixels apart
+EXTRA_DIGITS = 12
+# rough peak memory per pixel of perturbed_orbit's working state, which is only ever on one frame at a time
+ORBIT_BYTES_PER_PIXEL = 192
+
+def load_decimal_complex(s):
+    # like load_complex, but keeps every digit written, e.g. '-0.7436438870371587047521915+0.13182590420531197i'
+    if isinstance(s, (int, float)):
+        return Decimal(repr(s)), Decimal(0)
+    if isinstance(s, complex):
+        return Decimal(repr(s.real)), Decimal(repr(s.imag))
+    if not isinstance(s, str):
+        raise ValueError(f'Could not load complex number from {s} of type {type(s)}')
+    text = ''.join(s.split()).strip('()').replace('j', 'i')
+    number = r'[+-]?(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?'
+    if re.fullmatch(number, text):
+        return Decimal(text), Decimal(0)
+    match = re.fullmatch(rf'(?P<real>{number})??(?P<imag>{number}|[+-])?i', text)
+    if match is None:
+        raise ValueError(f'Could not load complex number from {s}')
+    real = Decimal(match['real']) if match['real'] else Decimal(0)
+    imag = match['imag'] or '1'
+    if imag in ['+', '-']:
+        imag += '1'
+    return real, Decimal(imag)
+
+def digits_needed(width, xpixels, zscale):
+    spacing = width * np.min(zscale) / xpixels
+    return max(20, ceil(-log10(spacing)) + EXTRA_DIGITS)
+
+def reference_orbit(center, power, steps, valmax, digits):
+    # the orbit of the center point, computed with digits of precision and then rounded to complex128.
+    # it stops after the first value that diverges (which is kept)
+    real, imag = center
+    zr = Decimal(0)
+    zi = Decimal(0)
+    limit = Decimal(valmax) ** 2
+    orbit = [0j]
+    with localcontext() as ctx:
+        ctx.prec = digits
+        for _ in range(steps):
+            pr, pi = zr, zi
+            for _ in range(power - 1):
+                pr, pi = pr * zr - pi * zi, pr * zi + pi * zr
+            zr = pr + real
+            zi = pi + imag
+            orbit.append(complex(float(zr), float(zi)))
+            if zr * zr + zi * zi >= limit:
+                break
+    return np.asarray(orbit, dtype=np.complex128)
+
+def _perturb(reference, delta, dc, power):
+    # (Z + delta)^power - Z^power + dc, expanded so it only involves delta and doesn't lose its precision
+    if power == 2:
+        return (2 * reference + delta) * delta + dc
+    total = comb(power, power)
+    for k in range(power - 1, 0, -1):
+        total = total * delta + comb(power, k) * reference ** (power - k)
+    return total * delta + dc
+
+def perturbed_orbit(reference, dc, power, valmax, steps, limit=None, on_step=None):
+    # iterates points at offsets dc (complex128) from the reference point, keeping track of each one only by its
+    # difference delta from the reference orbit. Each point has its own position m along the reference orbit; when
+    # it gets closer to 0 than to the reference, or runs out of reference orbit, it's rebased to m = 0
+    # (Z_0 = 0, so delta becomes its whole value), which avoids the glitches where precision gets lost.
+    # on_step (see Instruments.steps) is called after every step.
+    # returns the final values, how many steps each point took, and how many rebases happened
+    final = np.zeros(dc.size, dtype=np.complex128)
+    counts = np.zeros(dc.size, dtype=np.uint16)
+    valmax2 = valmax ** 2
+    last = reference.size - 1
+    state = {'index': np.arange(dc.size), 'dc': dc, 'delta': np.zeros(dc.size, dtype=np.complex128),
+             'm': np.zeros(dc.size, dtype=np.intp)}
+    if limit is not None:
+        keep = limit > 0
+        state = {key: value[keep] for key, value in state.items()}
+        state['limit'] = limit[keep]
+    rebased = 0
+    for ii in range(steps):
+        if state['index'].size == 0:
+            break
+        delta = _perturb(reference[state['m']], state['delta'], state['dc'], power)
+        state['m'] += 1
+        z = reference[state['m']] + delta
+        magnitude = z.real * z.real + z.imag * z.imag
+        rebase = (magnitude < delta.real * delta.real + delta.imag * delta.imag) | (state['m'] == last)
+        if rebase.any():
+            delta[rebase] = z[rebase]
+            state['m'][rebase] = 0
+            rebased += np.count_nonzero(rebase)
+        state['delta'] = delta
+        done = ~(magnitude < valmax2)
+        if limit is not None:
+            done |= state['limit'] <= ii + 1
+        if on_step is not None:
+            on_step(ii, state['index'].size - np.count_nonzero(done), state['index'].size)
+        if done.any():
+            finished = state['index'][done]
+            counts[finished] = ii + 1
+            final[finished] = z[done]
+            keep = ~done
+            state = {key: value[keep] for key, value in state.items()}
+    index = state['index']
+    counts[index] = steps
+    final[index] = reference[state['m']] + state['delta']
+    return final, counts, rebased
+
+class DeepFractal(Fractal):
+    # a Mandelbrot set around a center given to any precision, for zooms far past what complex64 can show.
+    # only the center's orbit is computed at high precision; every pixel is tracked by its (float64) difference from it
+    def __init__(self, xpixels, ypixels, center, width, height, zscale, frames=1, hooks=None):
+        super().__init__(xpixels, ypixels, -width / 2, width / 2, -height / 2, height / 2, zscale=zscale, frames=frames,
+                         hooks=hooks)
+        self.center = center
+        self.width = width
+        self.offsets = None
+        self.reference = None
+        self.rebased = 0
+
+    @phase('init')
+    def init_mandelbrot(self, power=2, valmax=2):
+        if isinstance(power, np.ndarray) or not float(power).is_integer() or power < 2:
+            raise ValueError(f'Deep zooms need a fixed whole number power of at least 2, but power was: {power}')
+        self.offsets = self.zscale[:, np.newaxis, np.newaxis] * self.grid()
+        self.array = np.zeros(self.offsets.shape, dtype=np.complex64)
+        self.iterations = np.zeros(self.offsets.shape, dtype=np.uint16)
+        self.power = int(power)
+        self.arraypower = False
+        center = complex(float(self.center[0]), float(self.center[1]))
+        self.param = np.broadcast_to(np.complex128(center), self.offsets.shape)
+        self.arrayparam = True
+        self.valmax = valmax
+        self.run_type = 'mandelbrot'
+
+    @phase('iterate')
+    def iterate(self, steps=1, log_interval=-1):
+        n = int(steps.max()) if isinstance(steps, np.ndarray) else steps
+        shape = self.array.shape
+        digits = digits_needed(self.width, self.xpixels, self.zscale)
+        if log_interval > 0:
+            print(f'Computing reference orbit with {digits} digits')
+        self.reference = reference_orbit(self.center, self.power, n, self.valmax, digits)
+        # one frame at a time, since perturbed_orbit's working state is several times the size of the frames it's on
+        frame_steps = np.broadcast_to(steps, shape[:1])
+        for ff in range(shape[0]):
+            frame_n = int(frame_steps[ff])
+            final, counts, rebased = perturbed_orbit(self.reference, self.offsets[ff].reshape(-1), self.power,
+                                                     self.valmax, frame_n, on_step=self.instruments.steps(frame_n))
+            self.rebased += rebased
+            self.array[ff] = final.reshape(shape[1:])
+            self.iterations[ff] += counts.reshape(shape[1:])
+        self.total_steps += n
+        self.to_show = self.iterations
+
+    def _sample(self, index, x, y, limit, n):
+        # for antialias: the points are offsets from the center like the pixels, so they follow the same reference orbit
+        if self.reference is None:
+            digits = digits_needed(self.width, self.xpixels, self.zscale)
+            self.reference = reference_orbit(self.center, self.power, n, self.valmax, digits)
+        frame = index // (self.iterations.shape[1] * self.iterations.shape[2])
+        dc = self.zscale[frame] * (x + 1j * y)
+        counts = np.zeros(index.size, dtype=np.uint16)
+        # a frame at a time like iterate (index is sorted, so each frame's points are together)
+        bounds = np.searchsorted(frame, np.arange(self.iterations.shape[0] + 1))
+        for start, stop in zip(bounds[:-1], bounds[1:]):
+            if start == stop:
+                continue
+            frame_n = int(limit[start])
+            _, counts[start:stop], _ = perturbed_orbit(self.reference, dc[start:stop], self.power, self.valmax, frame_n,
+                                                       on_step=self.instruments.steps(frame_n))
+        return counts
@@ -1,17 +1,63 @@
 import numpy as np
-from PIL import Image
+from PIL import GifImagePlugin, Image
 from matplotlib import cm
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from profiling import Instruments
+import functools
 import os
 
+# rough peak memory per pixel per frame, counting the arrays Fractal keeps plus temporaries from init, iterate and image
+BYTES_PER_PIXEL = 64
+# the same for iterate_compact and iterate_subdivide, which carry a compacted copy of each live point's state along
+# (more with interior, or power given per frame)
+COMPACT_BYTES_PER_PIXEL = 112
+# whole powers up to this are done by repeated multiplication instead of numpy's generic complex power
+MAX_MULTIPLY_POWER = 64
+# how often (in steps) orbit saves values to look for cycles, once that's longer than the steps so far
+PERIOD_CHECK_INTERVAL = 64
+# bit pattern (a nan) that orbit saves for points it already knows are in a cycle
+CYCLED = np.uint64(0xFFFFFFFFFFFFFFFF)
+# threads for encoding pngs (pillow releases the GIL while compressing)
+SAVE_THREADS = min(8, os.cpu_count() or 1)
+
+# uint8 RGBA lookup tables by colormap, see color_table
+_color_tables = {}
+# the last coordinate grid made, by window, see Fractal.grid. None (not kept) unless keep_grids was called
+_grids = None
+# where a gif's global color table starts, after its signature and logical screen descriptor
+GIF_PALETTE_OFFSET = 13
+# for each kind of symmetry (see Fractal.symmetry), how a pixel's value relates to its mirror image's:
+# (before any steps, after at least one step, params)
+SYMMETRIES = {
+    'conjugate': (np.conj, np.conj, np.conj),
+    'mirror': (lambda z: -np.conj(z), np.conj, np.conj),
+    'point': (np.negative, lambda z: z, lambda z: z),
+}
+
 def relative(*args):
     return os.path.join(os.path.dirname(__file__), *args)
 
+def phase(name):
+    # makes a method one of the phases a Fractal reports to its hooks (see Instruments.phase), passing on its
+    # log_interval so the steps it runs are printed
+    def decorate(method):
+        @functools.wraps(method)
+        def run(self, *args, **kwargs):
+            with self.instruments.phase(name, kwargs.get('log_interval', -1)):
+                return method(self, *args, **kwargs)
+        return run
+    return decorate
+
 class Fractal:
-    def __init__(self, xpixels, ypixels, xmin=-1, xmax=1, ymin=-1, ymax=1, zadd=None, zscale=None, frames=1):
+    def __init__(self, xpixels, ypixels, xmin=-1, xmax=1, ymin=-1, ymax=1, zadd=None, zscale=None, frames=1,
+                 xrange=None, yrange=None, hooks=None):
         self.frames = frames
         self.xpixels = xpixels
         self.ypixels = ypixels
+        # (start, stop) pixel ranges, to only generate a tile of the full xpixels by ypixels image
+        self.xrange = xrange
+        self.yrange = yrange
         self.xmin = xmin
         self.xmax = xmax
         self.ymin = ymin
@@ -21,7 +67,6 @@ class Fractal:
         else:
             self.zscale = zscale
         self.zadd = zadd
-        self.zscale = zscale
         self.total_steps = 0
         self.array = None
         self.iterations = None
@@ -31,12 +76,41 @@ class Fractal:
         self.arraypower = None
         self.arrayparam = None
         self.valmax = None
+        self.run_type = None
+        # how many pixels iterate_compact found would never diverge, and stopped early
+        self.interior_count = 0
+        # the edge pixels antialias supersampled (flat indices), with the mean of their samples' iterations and the
+        # fraction of their samples that never diverged, for show to blend in
+        self.supersampled = None
+        self.instruments = Instruments(hooks)
 
-    def init_julia(self, power=2, param=complex(-0.982, 0.21), valmax=2):
+    def axes(self):
         x = np.linspace(self.xmin, self.xmax, self.xpixels)
         y = np.linspace(self.ymin, self.ymax, self.ypixels)
-        zs, xs, ys = np.meshgrid(self.zscale, x, y, sparse=True, indexing='ij')
-        self.array = zs * (xs + 1j * ys)
+        if self.xrange is not None:
+            x = x[self.xrange[0]:self.xrange[1]]
+        if self.yrange is not None:
+            y = y[self.yrange[0]:self.yrange[1]]
+        return x, y
+
+    def grid(self):
+        # x + iy at every pixel (complex128, x by y). After keep_grids, the last one made is kept, so runs with the
+        # same window (e.g. a batch sweeping over param or power) don't build it again
+        if _grids is None:
+            x, y = self.axes()
+            return x[:, np.newaxis] + 1j * y[np.newaxis, :]
+        key = (self.xmin, self.xmax, self.ymin, self.ymax, self.xpixels, self.ypixels, self.xrange, self.yrange)
+        if key not in _grids:
+            _grids.clear()
+            x, y = self.axes()
+            grid = x[:, np.newaxis] + 1j * y[np.newaxis, :]
+            grid.flags.writeable = False
+            _grids[key] = grid
+        return _grids[key]
+
+    @phase('init')
+    def init_julia(self, power=2, param=complex(-0.982, 0.21), valmax=2):
+        self.array = self.zscale[:, np.newaxis, np.newaxis] * self.grid()
         if self.zadd is not None:
             self.array += self.zadd[:, np.newaxis, np.newaxis]
         self.array = self.array.astype(np.complex64, casting='same_kind', copy=False)
@@ -52,27 +126,29 @@ class Fractal:
         else:
             self.param = param
         self.valmax = valmax
+        self.run_type = 'julia'
 
+    @phase('init')
     def init_mandelbrot(self, power=2, valmax=2):
-        self.array = np.zeros((self.frames, self.xpixels, self.ypixels), dtype=np.complex64)
-        self.iterations = np.zeros((self.frames, self.xpixels, self.ypixels), dtype=np.uint16)
+        grid = self.grid()
+        self.array = np.zeros((self.frames, *grid.shape), dtype=np.complex64)
+        self.iterations = np.zeros((self.frames, *grid.shape), dtype=np.uint16)
         self.power = power
         self.arraypower = isinstance(power, np.ndarray)
         if self.arraypower:
             self.power = np.broadcast_to(power[:, np.newaxis, np.newaxis], self.array.shape)
         else:
             self.power = power
-        x = np.linspace(self.xmin, self.xmax, self.xpixels)
-        y = np.linspace(self.ymin, self.ymax, self.ypixels)
-        zs, xs, ys = np.meshgrid(self.zscale, x, y, indexing='ij')
-        self.param = zs * (xs + 1j * ys)
+        self.param = self.zscale[:, np.newaxis, np.newaxis] * grid
         if self.zadd is not None:
             self.param = self.param + self.zadd[:, np.newaxis, np.newaxis]
         self.param = self.param.astype(np.complex64, casting='same_kind', copy=False)
         self.arrayparam = True
         self.valmax = valmax
+        self.run_type = 'mandelbrot'
 
         
+    @phase('iterate')
     def iterate(self, steps=1, log_interval=-1):
         if isinstance(steps, np.ndarray):
             arraysteps = True
@@ -81,42 +157,458 @@ class Fractal:
         else:
             arraysteps = False
             n = steps
-        usepow = self.power
+        usepow = uniform(self.power)
+        arraypower = isinstance(usepow, np.ndarray)
+        kernel = power_kernel(usepow)
         usepar = self.param
-        prev = datetime.now()
+        valmax2 = self.valmax ** 2
+        on_step = self.instruments.steps(n)
         for ii in range(n):
-            if log_interval > 0 and ii % log_interval == 0:
-                cur = datetime.now()
-                print(f'{ii}/{n} (took {cur - prev})')
-                prev = cur
-            absarray = np.abs(self.array)
-            to_update = absarray < self.valmax
+            to_update = abs2(self.array) < valmax2
             if arraysteps:
                 to_update = np.logical_and(to_update, steps > ii)
-            if self.arraypower:
+            if arraypower:
                 usepow = self.power[to_update]
             if self.arrayparam:
                 usepar = self.param[to_update]
-            self.array[to_update] **= usepow
-            self.array[to_update] += usepar
+            updated = kernel(self.array[to_update], usepow)
+            updated += usepar
+            self.array[to_update] = updated
             self.iterations[to_update] += 1
             self.total_steps += 1
             self.to_show = self.iterations
+            if on_step is not None:
+                on_step(ii, np.count_nonzero(to_update))
+
+    @phase('iterate')
+    def iterate_compact(self, steps=1, log_interval=-1, interior=False, cardioid=False):
+        # same results as iterate, but steps only work on the pixels that haven't diverged yet (see orbit).
+        # with interior, pixels that get stuck in a cycle are stopped early, which doesn't change the results.
+        # with cardioid, power 2 Mandelbrot sets skip everything in the main cardioid and period 2 bulb;
+        # their iterations are the same but their values are just the cycle their orbits are drawn towards
+        shape = self.array.shape
+        frame_size = shape[1] * shape[2]
+        flat = self.array.reshape(-1)
+        iterations = self.iterations.reshape(-1)
+        live = np.flatnonzero(abs2(flat) < self.valmax ** 2)
+        if isinstance(steps, np.ndarray):
+            n = int(steps.max())
+            limit = steps[live // frame_size]
+            live = live[limit > 0]
+            limit = limit[limit > 0]
+        else:
+            n = steps
+            limit = None
+        usepow = _gather(self.power, live, frame_size) if self.arraypower else self.power
+        usepar = _gather(self.param, live, frame_size) if self.arrayparam else self.param
+        power = uniform(usepow)
+        if (cardioid and self.run_type == 'mandelbrot' and self.valmax >= 2
+                and not isinstance(power, np.ndarray) and power == 2):
+            inside, attractor = known_interior(usepar)
+            skipped = live[inside]
+            flat[skipped] = attractor[inside]
+            iterations[skipped] += limit[inside].astype(np.uint16) if limit is not None else n
+            self.interior_count += skipped.size
+            live = live[~inside]
+            usepar = usepar[~inside]
+            if limit is not None:
+                limit = limit[~inside]
+            if self.arraypower:
+                usepow = usepow[~inside]
+        final, counts, periodic = orbit(flat[live], usepar, usepow, self.valmax, n, limit=limit,
+                                        periodicity=interior, on_step=self.instruments.steps(n))
+        self.interior_count += periodic
+        flat[live] = final
+        iterations[live] += counts
+        if not np.shares_memory(flat, self.array):
+            self.array[...] = flat.reshape(shape)
+            self.iterations[...] = iterations.reshape(shape)
+        self.total_steps += n
+        self.to_show = self.iterations
+
+    @phase('iterate')
+    def iterate_shared(self, steps=1, method='iterate', log_interval=-1, **kwargs):
+        # runs the iterate method (e.g. iterate_compact), but frames that start out the same (same grid, param and
+        # power) are only computed once: in order of their steps, each one carries on from the previous one's results
+        # for just the extra steps, so a group costs as much as its longest frame. iterate_subdivide can't carry on,
+        # so its group is run once for the most steps and each frame's iterations are cut off at its own steps
+        groups = self.shared_frames()
+        if len(groups) == self.array.shape[0]:
+            getattr(self, method)(steps, log_interval=log_interval, **kwargs)
+            return
+        if log_interval > 0:
+            print(f'{len(groups)} distinct frames out of {self.array.shape[0]}')
+        frame_steps = steps if isinstance(steps, np.ndarray) else np.full(self.array.shape[0], steps)
+        for group in groups:
+            group = sorted(group, key=lambda ff: frame_steps[ff])
+            if method == 'iterate_subdivide':
+                last = group[-1]
+                self._run_view(last, method, int(frame_steps[last]), 0, log_interval, kwargs)
+                for ff in group[:-1]:
+                    self.array[ff] = self.array[last]
+                    np.minimum(self.iterations[last], np.uint16(frame_steps[ff]), out=self.iterations[ff])
+                continue
+            done = 0
+            for prev, ff in zip([None] + group[:-1], group):
+                if prev is not None:
+                    self.array[ff] = self.array[prev]
+                    self.iterations[ff] = self.iterations[prev]
+                extra = int(frame_steps[ff]) - done
+                if extra > 0:
+                    self._run_view(ff, method, extra, done, log_interval, kwargs)
+                done += extra
+        self.total_steps += int(frame_steps.max())
+        self.to_show = self.iterations
+
+    def shared_frames(self):
+        # groups of frames whose starting arrays, iterations, params and powers are all identical
+        def first(values, ff):
+            # the value for a frame, if it's one value broadcast over the whole frame
+            if isinstance(values, np.ndarray) and values.strides[1:] == (0, 0):
+                return values[ff, 0, 0].item()
+            return None
+
+        buckets = {}
+        for ff in range(self.array.shape[0]):
+            key = (self.zscale[ff].item() if isinstance(self.zscale, np.ndarray) else self.zscale,
+                   self.zadd[ff].item() if self.zadd is not None else None,
+                   first(self.param, ff), first(self.power, ff))
+            for group in buckets.setdefault(key, []):
+                if self._same_frame(group[0], ff):
+                    group.append(ff)
+                    break
+            else:
+                buckets[key].append([ff])
+        return [group for groups in buckets.values() for group in groups]
+
+    def _same_frame(self, f0, f1):
+        arrays = [self.array, self.iterations]
+        if self.arrayparam:
+            arrays.append(self.param)
+        if self.arraypower:
+            arrays.append(self.power)
+        return all(np.array_equal(values[f0], values[f1]) for values in arrays)
+
+    def _view(self, f0, f1, x0=0, x1=None, y0=0, y1=None):
+        # a Fractal for just frames f0 to f1 and pixels x0 to x1, y0 to y1, whose arrays are views into this one's
+        # (so iterating it updates this one, except for methods that replace the arrays, see _update)
+        x1 = self.array.shape[1] if x1 is None else x1
+        y1 = self.array.shape[2] if y1 is None else y1
+        xstart = self.xrange[0] if self.xrange is not None else 0
+        ystart = self.yrange[0] if self.yrange is not None else 0
+        view = Fractal(self.xpixels, self.ypixels, self.xmin, self.xmax, self.ymin, self.ymax,
+                       zadd=per_frame(self.zadd, f0, f1), zscale=per_frame(self.zscale, f0, f1),
+                       frames=f1 - f0, xrange=(xstart + x0, xstart + x1), yrange=(ystart + y0, ystart + y1))
+        view.array = self.array[f0:f1, x0:x1, y0:y1]
+        view.iterations = self.iterations[f0:f1, x0:x1, y0:y1]
+        view.power = self.power[f0:f1, x0:x1, y0:y1] if self.arraypower else self.power
+        view.param = self.param[f0:f1, x0:x1, y0:y1] if self.arrayparam else self.param
+        view.arraypower = self.arraypower
+        view.arrayparam = self.arrayparam
+        view.valmax = self.valmax
+        view.run_type = self.run_type
+        view.total_steps = self.total_steps
+        view.instruments = self.instruments
+        return view
+
+    def _update(self, view, f0, f1, x0=0, x1=None, y0=0, y1=None):
+        # copies a view's results back, in case its method replaced its arrays instead of changing them in place
+        self.array[f0:f1, x0:x1, y0:y1] = view.array
+        self.iterations[f0:f1, x0:x1, y0:y1] = view.iterations
+        self.interior_count += view.interior_count
+
+    def _run_view(self, ff, method, steps, done, log_interval, kwargs):
+        view = self._view(ff, ff + 1)
+        view.total_steps += done
+        getattr(view, method)(steps, log_interval=log_interval, **kwargs)
+        self._update(view, ff, ff + 1)
+
+    @phase('iterate')
+    def iterate_symmetric(self, steps=1, method='iterate', log_interval=-1, **kwargs):
+        # runs iterate_shared on just the part of the image that isn't a mirror image of another part (see symmetry),
+        # and fills in the rest by reflecting it. Not for iterate_wrapping, which keeps iterating diverged points
+        found = self.symmetry()
+        if found is None:
+            self.iterate_shared(steps, method=method, log_interval=log_interval, **kwargs)
+            return
+        region, reflections = found
+        if log_interval > 0:
+            x0, x1, y0, y1 = region
+            print(f'{(x1 - x0) * (y1 - y0)} of {self.array.shape[1] * self.array.shape[2]} pixels computed, '
+                  f'the rest are mirror images')
+        view = self._view(0, self.array.shape[0], *region)
+        view.iterate_shared(steps, method=method, log_interval=log_interval, **kwargs)
+        self._update(view, 0, self.array.shape[0], *region)
+        self.reflect(reflections)
+        self.total_steps = view.total_steps
+        self.to_show = self.iterations
+
+    def symmetry(self):
+        # looks for parts of the image that are exact mirror images of other parts, given the window, param and power.
+        # z^p + c with a whole power p has conjugate symmetry (iterating conj(z) with conj(c) gives the conjugate of
+        # iterating z with c), so Mandelbrot sets and Julia sets with a real param mirror across the real axis. With
+        # an even power, -z lands on the same value as z after one step, so Julia sets have point symmetry around 0,
+        # and with a real param they also mirror across the imaginary axis.
+        # the pixels have to line up exactly, which is checked against the arrays themselves (so it also works when
+        # carrying on from a previous run). returns the (x0, x1, y0, y1) pixels that still need computing along with
+        # the reflections that fill in the rest (see reflect), or None if there's nothing to reflect
+        power = uniform(self.power)
+        if (isinstance(power, np.ndarray) or not float(power).is_integer()
+                or not 1 <= power <= MAX_MULTIPLY_POWER or self.array.size == 0):
+            return None
+        region = [0, self.array.shape[1], 0, self.array.shape[2]]
+        kinds = [('conjugate', 2), ('mirror', 1)] if power % 2 == 0 else [('conjugate', 2)]
+        reflections = []
+        for kind, axis in kinds:
+            reflection = self._reflection(kind, axis, region)
+            if reflection is not None:
+                reflections.append(reflection)
+        if not reflections and power % 2 == 0:
+            for axis in [2, 1]:
+                reflection = self._reflection('point', axis, region)
+                if reflection is not None:
+                    reflections.append(reflection)
+                    break
+        if not reflections:
+            return None
+        return tuple(region), reflections
+
+    def _reflection(self, kind, axis, region):
+        # the reflection of this kind along axis (1 for x, 2 for y) within region, which it shrinks to leave out the
+        # reflected pixels. Only the side towards the nearer edge is reflected, so what's left stays a rectangle
+        x, y = self.axes()
+        coords = x if axis == 1 else y
+        if coords.size < 2:
+            return None
+        zscale = self.zscale[0] if self.zscale is not None else 1
+        zadd = self.zadd[0] if self.zadd is not None else 0
+        shift = zadd.real if axis == 1 else zadd.imag
+        # s is the index where 0 is, times 2, so pixel k mirrors pixel s - k
+        s = int(round(2 * (-shift / zscale - coords[0]) / (coords[1] - coords[0])))
+        lo, hi = region[2 * axis - 2:2 * axis]
+        if s <= lo + hi - 1:
+            reflected = (lo, (s + 1) // 2)
+            kept = (reflected[1], hi)
+        else:
+            reflected = (s // 2 + 1, hi)
+            kept = (lo, reflected[0])
+        other = None
+        if kind == 'point':
+            # pixels also mirror along the other axis, which has to be symmetric over the whole region
+            oaxis = 3 - axis
+            olo, ohi = region[2 * oaxis - 2:2 * oaxis]
+            other = (oaxis, olo, ohi, olo + ohi - 1)
+        if reflected[0] >= reflected[1] or not self._mirrors(kind, axis, s, reflected, other):
+            return None
+        region[2 * axis - 2:2 * axis] = kept
+        return kind, axis, s, reflected, other
+
+    def _partners(self, values, axis, s, reflected, other):
+        # values at the pixels mirroring the ones in reflected
+        values = np.take(values, s - np.arange(*reflected), axis=axis)
+        if other is not None:
+            oaxis, olo, ohi, ocenter = other
+            values = np.take(values, ocenter - np.arange(olo, ohi), axis=oaxis)
+        return values
+
+    def _own(self, axis, reflected, other):
+        index = [slice(None)] * 3
+        index[axis] = slice(*reflected)
+        if other is not None:
+            index[other[0]] = slice(other[1], other[2])
+        return tuple(index)
+
+    def _mirrors(self, kind, axis, s, reflected, other):
+        # whether the pixels in reflected really are mirror images, in their iterations, values and param
+        before, after, param = SYMMETRIES[kind]
+        own = self._own(axis, reflected, other)
+        iterations = self._partners(self.iterations, axis, s, reflected, other)
+        if not np.array_equal(self.iterations[own], iterations):
+            return False
+        values = self._partners(self.array, axis, s, reflected, other)
+        if not np.array_equal(self.array[own], np.where(iterations > 0, after(values), before(values))):
+            return False
+        if not self.arrayparam:
+            return param(self.param) == self.param
+        if self.param.strides[1:] == (0, 0):
+            return np.array_equal(param(self.param[:, 0, 0]), self.param[:, 0, 0])
+        return np.array_equal(self.param[own], param(self._partners(self.param, axis, s, reflected, other)))
+
+    def reflect(self, reflections):
+        # fills in the pixels left out by symmetry from their mirror images. Pixels that never took a step
+        # (they started out diverged) keep their own starting values
+        for kind, axis, s, reflected, other in reversed(reflections):
+            _, after, _ = SYMMETRIES[kind]
+            own = self._own(axis, reflected, other)
+            iterations = self._partners(self.iterations, axis, s, reflected, other)
+            values = self._partners(self.array, axis, s, reflected, other)
+            self.array[own] = np.where(iterations > 0, after(values), self.array[own])
+            self.iterations[own] = iterations
+
+    @phase('iterate')
+    def iterate_subdivide(self, steps=1, min_size=16, log_interval=-1, interior=False):
+        # Mariani-Silver subdivision: only the borders of each rectangle are iterated, and if every border pixel took
+        # the same number of iterations, the inside is filled in with that number. Otherwise the rectangle is split
+        # into four (sharing their middle lines) and those are checked in turn, down to min_size, below which the rest
+        # is iterated directly. Filled pixels get iterations but keep their starting values.
+        # the points lasting longer than a border's count form one connected region (for connected sets), so the only
+        # way a rectangle can hide some is by containing all of them. so a rectangle is only filled if it's inside the
+        # set, or something outside it that's already been iterated lasted longer than its border.
+        # each level's rectangles are handled together as arrays, and their borders are all iterated by one orbit
+        shape = self.array.shape
+        frame_size = shape[1] * shape[2]
+        flat = self.array.reshape(-1)
+        iterations = self.iterations.reshape(-1)
+        n = int(steps.max()) if isinstance(steps, np.ndarray) else steps
+        frame_steps = steps if isinstance(steps, np.ndarray) else np.full(shape[0], steps)
+        computed = np.zeros(flat.size, dtype=bool)
+
+        def compute(index):
+            needed = np.zeros(flat.size, dtype=bool)
+            needed[index] = True
+            live = np.flatnonzero(needed & ~computed)
+            limit = steps[live // frame_size] if isinstance(steps, np.ndarray) else None
+            usepow = _gather(self.power, live, frame_size) if self.arraypower else self.power
+            usepar = _gather(self.param, live, frame_size) if self.arrayparam else self.param
+            final, counts, periodic = orbit(flat[live], usepar, usepow, self.valmax, n, limit=limit,
+                                            periodicity=interior, on_step=self.instruments.steps(n))
+            self.interior_count += periodic
+            flat[live] = final
+            iterations[live] += counts
+            computed[live] = True
+            return live.size
+
+        def inside(ff, x0, x1, y0, y1):
+            # flat indices of every pixel in the rectangles, along with the rectangle each one belongs to
+            heights = x1 - x0
+            widths = y1 - y0
+            row_starts = _runs(ff * frame_size + x0 * shape[2] + y0, heights, shape[2])
+            row_rects = np.repeat(np.arange(ff.size), heights)
+            return _runs(row_starts, widths[row_rects]), np.repeat(row_rects, widths[row_rects])
 
-    def iterate_wrapping(self, n=1, log_interval=-1):
+        rects = [np.arange(shape[0]), np.zeros(shape[0], int), np.full(shape[0], shape[1]),
+                 np.zeros(shape[0], int), np.full(shape[0], shape[2])]
+        level = 0
+        while rects[0].size > 0:
+            ff, x0, x1, y0, y1 = rects
+            corner = ff * frame_size + x0 * shape[2] + y0
+            heights = x1 - x0
+            widths = y1 - y0
+            edges = [(corner, widths, 1), (corner + (heights - 1) * shape[2], widths, 1),
+                     (corner, heights, shape[2]), (corner + widths - 1, heights, shape[2])]
+            edges = [(_runs(edge_start, length, stride), np.cumsum(length) - length)
+                     for edge_start, length, stride in edges]
+            count = compute(np.concatenate([index for index, _ in edges]))
+            if log_interval > 0:
+                print(f'Level {level}: {ff.size} rectangles, {count} pixels iterated')
+            lowest = np.min([np.minimum.reduceat(iterations[index], offsets) for index, offsets in edges], axis=0)
+            highest = np.max([np.maximum.reduceat(iterations[index], offsets) for index, offsets in edges], axis=0)
+            longest = iterations.reshape(shape).max(axis=(1, 2))
+            fill = (lowest == highest) & ((lowest < longest[ff]) | (lowest >= frame_steps[ff]))
+            small = ~fill & ((heights <= min_size) | (widths <= min_size))
+            split = ~fill & ~small
+            index, owner = inside(ff[fill], x0[fill] + 1, x1[fill] - 1, y0[fill] + 1, y1[fill] - 1)
+            iterations[index] = lowest[fill][owner]
+            computed[index] = True
+            index, _ = inside(ff[small], x0[small], x1[small], y0[small], y1[small])
+            count = compute(index)
+            if log_interval > 0 and count > 0:
+                print(f'Level {level}: {count} pixels in small rectangles iterated')
+            ff, x0, x1, y0, y1 = [value[split] for value in rects]
+            xm = (x0 + x1) // 2
+            ym = (y0 + y1) // 2
+            rects = [np.concatenate(parts) for parts in [(ff, ff, ff, ff), (x0, xm, x0, xm), (xm + 1, x1, xm + 1, x1),
+                                                         (y0, y0, ym, ym), (ym + 1, ym + 1, y1, y1)]]
+            level += 1
+        if not np.shares_memory(flat, self.array):
+            self.array[...] = flat.reshape(shape)
+            self.iterations[...] = iterations.reshape(shape)
+        self.total_steps += n
+        self.to_show = self.iterations
+
+    @phase('iterate')
+    def iterate_wrapping(self, n=1, log_interval=-1, fill=True):
+        # with fill off, points that haven't diverged yet are left at 0 iterations instead of total_steps,
+        # so it can carry on from where it stopped (e.g. from a checkpoint); iterate_wrapping(0) fills them in later
+        kernel = power_kernel(uniform(self.power))
+        valmax2 = self.valmax ** 2
+        on_step = self.instruments.steps(n)
         for ii in range(n):
-            if log_interval > 0 and ii % log_interval == 0: 
-                print(f'{ii}/{n}') 
-            self.array **= self.power
+            self.array = kernel(self.array, self.power)
             self.array += self.param
-            absarray = np.abs(self.array)
-            divergent = absarray > self.valmax
+            divergent = abs2(self.array) > valmax2
             self.array[divergent] = 0
-            self.iterations[divergent] = ii + 1
+            self.iterations[divergent] = self.total_steps + 1
             self.total_steps += 1
-        self.iterations[self.iterations == 0] = self.total_steps
+            if on_step is not None:
+                on_step(ii, np.count_nonzero(self.iterations == 0), self.array.size)
+        if fill:
+            self.iterations[self.iterations == 0] = self.total_steps
         self.to_show = self.array
 
+    @phase('antialias')
+    def antialias(self, steps, samples=2, log_interval=-1):
+        # adaptive supersampling: pixels whose iterations differ from any of their neighbors' are computed again at
+        # samples by samples points spread evenly over their square, with the same kernel and steps (fixed or per
+        # frame) as before, and show blends those samples together for color_by iterations or diverged.
+        # every other pixel keeps its one sample, so this costs a small fraction of rendering at samples times the size.
+        # pixels count as undiverged against total_steps, so it has to be set to its final value first
+        shape = self.iterations.shape
+        frame_size = shape[1] * shape[2]
+        edge = np.zeros(shape, dtype=bool)
+        for axis in [1, 2]:
+            first = [slice(None)] * 3
+            second = [slice(None)] * 3
+            first[axis] = slice(1, None)
+            second[axis] = slice(None, -1)
+            different = self.iterations[tuple(first)] != self.iterations[tuple(second)]
+            edge[tuple(first)] |= different
+            edge[tuple(second)] |= different
+        index = np.flatnonzero(edge)
+        frame_steps = np.broadcast_to(steps, shape[:1])
+        n = int(frame_steps.max())
+        limit = frame_steps[index // frame_size]
+        x, y = self.axes()
+        xstep = (self.xmax - self.xmin) / (self.xpixels - 1) if self.xpixels > 1 else 0
+        ystep = (self.ymax - self.ymin) / (self.ypixels - 1) if self.ypixels > 1 else 0
+        px = x[index // shape[2] % shape[1]]
+        py = y[index % shape[2]]
+        offsets = (np.arange(samples) + 0.5) / samples - 0.5
+        total = np.zeros(index.size)
+        inside = np.zeros(index.size)
+        for xoffset in offsets:
+            for yoffset in offsets:
+                if xoffset == 0 and yoffset == 0:
+                    # the middle sample (for odd samples) is the pixel itself
+                    counts = self.iterations.reshape(-1)[index]
+                else:
+                    counts = self._sample(index, px + xoffset * xstep, py + yoffset * ystep, limit, n)
+                total += counts
+                inside += counts == self.total_steps
+        self.supersampled = (index, total / samples ** 2, inside / samples ** 2)
+
+    def _sample(self, index, x, y, limit, n):
+        # how many steps the points x + iy take (each standing in for the pixel at flat index), started the same way
+        # the pixels were by init_julia or init_mandelbrot
+        shape = self.iterations.shape
+        frame_size = shape[1] * shape[2]
+        frame = index // frame_size
+        point = np.broadcast_to(self.zscale, shape[:1])[frame] * (x + 1j * y)
+        if self.zadd is not None:
+            point = point + np.broadcast_to(self.zadd, shape[:1])[frame]
+        point = point.astype(np.complex64)
+        usepow = _gather(self.power, index, frame_size) if self.arraypower else self.power
+        if self.run_type == 'mandelbrot':
+            z = np.zeros(index.size, dtype=np.complex64)
+            usepar = point
+        else:
+            z = point
+            usepar = _gather(self.param, index, frame_size) if self.arrayparam else self.param
+        _, counts, _ = orbit(z, usepar, usepow, self.valmax, n, limit=limit, periodicity=True,
+                             on_step=self.instruments.steps(n))
+        return counts
+
+    @phase('show')
     def show(self, show_type='iterations', normalize_frame_depths=True):
         if normalize_frame_depths:
             self.iterations[:, 0, 0] = 0
@@ -151,8 +643,21 @@ class Fractal:
             self.to_show[self.iterations > self.total_steps] = 0
         else:
             print('Invalid display type')
+        if self.supersampled is not None and show_type in ['iterations', 'diverged']:
+            index, mean, inside = self.supersampled
+            # a diverged sample shows its iterations, an undiverged one 0
+            blended = mean - inside * self.total_steps if show_type == 'diverged' else mean
+            to_show = self.to_show.astype(np.float64)
+            to_show.reshape(-1)[index] = blended
+            if normalize_frame_depths:
+                to_show[:, 0, :2] = self.to_show[:, 0, :2]
+            self.to_show = to_show
 
-    def image(self, folder=None, grayscale=False, colormap=None, animate=True, seconds=0):
+    @phase('image')
+    def image(self, folder=None, grayscale=False, colormap=None, animate=True, seconds=0, gif=None, first_frame=0,
+              show=True):
+        # if gif is given, frames are appended to that GifWriter (numbered from first_frame) and it's left open,
+        # so an animation can be written a batch of frames at a time. With show, a single image is opened once saved
         if colormap is None:
             colormap = cm.viridis
         if self.to_show is None:
@@ -160,60 +665,364 @@ class Fractal:
             return
         if folder is None:
             folder = 'output'
-        images = []
-        print(f"Saving image{'s' if self.to_show.shape[0] > 1 else ''}...")
-        for ii in range(self.to_show.shape[0]):
-            abs_array = np.abs(self.to_show[ii])
-            if abs_array.max() > 0:
-                scaled = abs_array / abs_array.max()
-            else:
-                scaled = abs_array
-            scaled = np.transpose(np.flip(scaled, axis=1))
-            if grayscale:
-                im = Image.fromarray(np.uint8(scaled * 255), 'L')
-            else:
-                im = Image.fromarray(np.uint8(colormap(scaled) * 255), 'RGBA')
-            if self.arrayparam:
-                angle = np.angle(self.param[ii][0][0], deg=True)
-                radius = np.abs(self.param[ii][0][0])
-            else:
-                radius = np.abs(self.param)
-                angle = np.angle(self.param, deg=True)
-            if self.arraypower:
-                power = self.power[ii][0][0]
-            else:
-                power = self.power
-            angle_str = f'a{angle % 360:.02f}'.replace('.', '_')
-            pow_str = f'p{power:.02f}'.replace('.', '_')
-            rad_str = f'r{radius:.02f}'.replace('.', '_')
-            filename = f'fractal{ii:04}_{pow_str}_{angle_str}_{rad_str}.png'
-            im.save(relative('output', folder, filename))
-            if animate:
-                images.append(im)
-            elif ii == 0:
-                im.show()
-        if animate:
-            if len(images) > 1:
-                save_gif(images, relative(folder, 'fractal_animated.gif'), seconds=seconds)
-            else:
-                print('Cannot animate as there is only one frame')
+        frames = self.to_show.shape[0]
+        own_gif = gif is None and animate and frames > 1
+        if own_gif:
+            gif = GifWriter(relative(folder, 'fractal_animated.gif'), duration=gif_duration(seconds, frames))
+        elif gif is None and animate:
+            print('Cannot animate as there is only one frame')
+        print(f"Saving image{'s' if frames > 1 else ''}...")
+        if not grayscale:
+            lut = color_table(colormap)
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=SAVE_THREADS) as pool:
+            for ii in range(frames):
+                abs_array = np.abs(self.to_show[ii])
+                if abs_array.max() > 0:
+                    scaled = abs_array / abs_array.max()
+                else:
+                    scaled = abs_array
+                # the image's rows are the y axis from the top down, which is just a view of the (x, y) array
+                if grayscale:
+                    im = Image.fromarray(np.uint8(scaled.T[::-1] * 255), 'L')
+                    frame = im
+                else:
+                    index = color_index(scaled, len(lut) - 1).T[::-1]
+                    im = Image.fromarray(np.take(lut, index, axis=0), 'RGBA')
+                    frame = palette_image(index, lut) if gif is not None else None
+                if self.arrayparam:
+                    angle = np.angle(self.param[ii][0][0], deg=True)
+                    radius = np.abs(self.param[ii][0][0])
+                else:
+                    radius = np.abs(self.param)
+                    angle = np.angle(self.param, deg=True)
+                if self.arraypower:
+                    power = self.power[ii][0][0]
+                else:
+                    power = self.power
+                angle_str = f'a{angle % 360:.02f}'.replace('.', '_')
+                pow_str = f'p{power:.02f}'.replace('.', '_')
+                rad_str = f'r{radius:.02f}'.replace('.', '_')
+                filename = f'fractal{ii + first_frame:04}_{pow_str}_{angle_str}_{rad_str}.png'
+                pending.append(pool.submit(im.save, relative('output', folder, filename)))
+                # only a few frames are kept waiting to be saved at once
+                while len(pending) > SAVE_THREADS * 2:
+                    pending.popleft().result()
+                if gif is not None:
+                    with self.instruments.phase('gif'):
+                        gif.append(frame)
+                elif show and not animate and ii == 0:
+                    im.show()
+            for future in pending:
+                future.result()
+        if own_gif:
+            with self.instruments.phase('gif'):
+                gif.close()
 
-def save_gif(images, path, seconds=-1):
-    for ii in range(len(images)):
-        images[ii] = images[ii].convert('P', palette=Image.ADAPTIVE)
-    if seconds > 0:
-        duration = seconds * 1000 / len(images)
+def color_table(colormap):
+    # the colormap's colors as uint8 RGBA, exactly what np.uint8(colormap(scaled) * 255) gives, with one more row
+    # at the end for nan (matplotlib's "bad" color). Built once per colormap
+    key = (colormap.name, colormap.N)
+    if key not in _color_tables:
+        colors = np.append(colormap(np.arange(colormap.N)), [colormap.get_bad()], axis=0)
+        _color_tables[key] = np.uint8(colors * 255)
+    return _color_tables[key]
+
+def color_index(scaled, n):
+    # which of n colors each value from 0 to 1 gets, computed the same way as matplotlib's colormaps. scaled is
+    # overwritten; nan gets index n
+    if scaled.dtype.kind != 'f':
+        return np.minimum(scaled, n - 1).astype(np.uint16)
+    scaled *= n
+    np.minimum(scaled, n - 1, out=scaled)
+    index = scaled.astype(np.uint16)
+    index[np.isnan(scaled)] = n
+    return index
+
+def abs2(z):
+    # squared absolute value, which is all the divergence checks need and skips the square root
+    real = z.real
+    imag = z.imag
+    result = real * real
+    result += imag * imag
+    return result
+
+def uniform(values):
+    # a single number if every frame (or point) uses the same value, so a faster kernel can be picked
+    if not isinstance(values, np.ndarray):
+        return values
+    if values.ndim == 3 and values.strides[1] == 0 and values.strides[2] == 0:
+        check = values[:, 0, 0]
     else:
-        duration = 50
-    images[0].save(path, save_all=True, append_images=images[1:], duration=duration, loop=0, disposal=2)
+        check = values.reshape(-1)
+    if check.size == 0 or not np.all(check == check[0]):
+        return values
+    # kept as a numpy scalar (unless it's whole), so it's computed at the same precision as the array would be
+    value = check[0]
+    if np.isrealobj(value) and float(value).is_integer():
+        return int(value)
+    return value
+
+def _integer_power(z, n):
+    # exponentiation by squaring, which is only complex multiplications
+    if n == 1:
+        return z
+    if n == 2:
+        return np.square(z, out=z)
+    result = None
+    while n > 0:
+        if n & 1:
+            result = z.copy() if result is None else np.multiply(result, z, out=result)
+        n >>= 1
+        if n > 0:
+            z = z * z
+    return result
+
+def power_kernel(power):
+    # returns f(z, power) that raises the complex64 array z to power, possibly in place.
+    # whole powers use repeated multiplication, which is a lot faster than numpy's generic complex power
+    if not isinstance(power, np.ndarray) and float(power).is_integer() and 1 <= power <= MAX_MULTIPLY_POWER:
+        n = int(power)
+        return lambda z, _: _integer_power(z, n)
+    return lambda z, p: np.power(z, p, out=z)
+
+def orbit(z, param, power, valmax, steps, limit=None, periodicity=False, on_step=None):
+    # iterates the complex64 points z for steps steps (or limit[i] steps for point i, if given), stopping each point
+    # once it diverges. param and power are fixed or given per point. Only the points that are still going are kept,
+    # compacted along with their index into z, so each step costs about as much as the number of live points.
+    # on_step (see Instruments.steps) is called after every step.
+    # returns the final value of each point, how many steps it took, and how many points were found to be periodic.
+    final = z.copy()
+    counts = np.zeros(z.size, dtype=np.uint16)
+    valmax2 = valmax ** 2
+    # everything in state is carried along (and compacted) every step, so it's kept as small as it can be
+    index = np.flatnonzero(abs2(z) < valmax2).astype(np.int32 if z.size < 2**31 else np.intp)
+    state = {'index': index}
+    if limit is not None:
+        limit = limit[index]
+        state['index'] = index = index[limit > 0]
+        state['limit'] = limit[limit > 0].astype(np.uint16)
+    elif periodicity:
+        state['limit'] = np.full(index.size, steps, dtype=np.uint16)
+    power = uniform(power)
+    kernel = power_kernel(power)
+    state['z'] = z[index]
+    state['param'] = param[index] if isinstance(param, np.ndarray) else param
+    state['power'] = power[index] if isinstance(power, np.ndarray) else power
+    # with periodicity, each point's value is saved every so often, and if the point lands exactly on its saved value
+    # again then it's stuck in a cycle and can never diverge. It only needs to run however many more steps put it in
+    # the same place in the cycle as its last step would, and is credited with the steps it skipped.
+    periodic = 0
+    if periodicity:
+        # compared bit for bit as integers, which is quicker than comparing complex numbers
+        state['saved'] = state['z'].view(np.uint64).copy()
+        state['credit'] = np.zeros(index.size, dtype=np.uint16)
+    # points that finish are only dropped from state once enough of them have piled up, until then they're
+    # masked out of alive (their values keep being updated, but are never read again)
+    alive = None
+    dead = 0
+    saved_step = 0
+    for ii in range(steps):
+        if state['index'].size == dead:
+            break
+        with np.errstate(over='ignore', invalid='ignore'):
+            state['z'] = kernel(state['z'], state['power'])
+            state['z'] += state['param']
+            done = ~(abs2(state['z']) < valmax2)
+        if periodicity:
+            cycled = state['z'].view(np.uint64) == state['saved']
+            cycled &= ~done
+            if alive is not None:
+                cycled &= alive
+            if cycled.any():
+                period = ii + 1 - saved_step
+                remaining = state['limit'][cycled] - (ii + 1)
+                skipped = remaining - remaining % period
+                state['limit'][cycled] -= skipped
+                state['credit'][cycled] = skipped
+                # so these aren't caught again (a diverged value would have to match it, which is never checked)
+                state['saved'][cycled] = CYCLED
+                periodic += np.count_nonzero(cycled)
+            if (ii + 1) & ii == 0 or (ii + 1) % PERIOD_CHECK_INTERVAL == 0:
+                np.copyto(state['saved'], state['z'].view(np.uint64), where=state['saved'] != CYCLED)
+                saved_step = ii + 1
+        if 'limit' in state:
+            done |= state['limit'] <= ii + 1
+        if alive is not None:
+            done &= alive
+        finishing = np.count_nonzero(done)
+        if on_step is not None:
+            # the points already finished but not dropped yet were iterated too
+            on_step(ii, state['index'].size - dead - finishing, state['index'].size)
+        if finishing == 0:
+            continue
+        finished = state['index'][done]
+        counts[finished] = ii + 1
+        if periodicity:
+            counts[finished] += state['credit'][done]
+        final[finished] = state['z'][done]
+        if alive is None:
+            alive = ~done
+        else:
+            alive &= ~done
+        dead += finishing
+        if dead * 4 >= state['index'].size:
+            for key, value in state.items():
+                if isinstance(value, np.ndarray):
+                    state[key] = value[alive]
+            alive = None
+            dead = 0
+    if alive is not None:
+        for key, value in state.items():
+            if isinstance(value, np.ndarray):
+                state[key] = value[alive]
+    index = state['index']
+    counts[index] = steps
+    final[index] = state['z']
+    return final, counts, periodic
+
+def known_interior(c):
+    # which of the points c are in the main cardioid or period 2 bulb of the power 2 Mandelbrot set,
+    # whose orbits never diverge, along with the point of the cycle those orbits are drawn towards
+    x = c.real.astype(np.float64)
+    y2 = c.imag.astype(np.float64) ** 2
+    q = (x - 0.25) ** 2 + y2
+    cardioid = q * (q + x - 0.25) < y2 / 4
+    bulb = (x + 1) ** 2 + y2 < 1 / 16
+    attractor = np.zeros(c.size, dtype=np.complex64)
+    inside = c[cardioid].astype(np.complex128)
+    attractor[cardioid] = (1 - np.sqrt(1 - 4 * inside)) / 2
+    inside = c[bulb].astype(np.complex128)
+    attractor[bulb] = (np.sqrt(-3 - 4 * inside) - 1) / 2
+    return cardioid | bulb, attractor
+
+def _runs(starts, lengths, stride=1):
+    # indices of runs of lengths[i] values, going from starts[i] in steps of stride
+    offsets = np.repeat(np.cumsum(lengths) - lengths, lengths)
+    return np.repeat(starts, lengths) + (np.arange(offsets.size) - offsets) * stride
+
+def _gather(values, index, frame_size):
+    # values is (frames, xpixels, ypixels), either a full array or a per-frame value broadcast over each frame
+    if values.strides[1] == 0 and values.strides[2] == 0:
+        return values[:, 0, 0][index // frame_size]
+    return values.reshape(-1)[index]
+
+def per_frame(value, start, stop):
+    # the frames start:stop of a value that's either fixed or given per frame
+    if isinstance(value, np.ndarray):
+        return value[start:stop]
+    return value
+
+def keep_grids():
+    # from now on, keep the last coordinate grid made (see Fractal.grid). It's 16 bytes per pixel held for as long as
+    # the process runs, so only worth it for a process running many configs, like batch.py's
+    global _grids
+    if _grids is None:
+        _grids = {}
+
+def frames_per_batch(xpixels, ypixels, max_memory, bytes_per_pixel=BYTES_PER_PIXEL, working=0):
+    # how many frames can be generated at once in roughly max_memory megabytes, with working bytes per pixel
+    # also needed for just one frame at a time
+    budget = max_memory * 2**20 - working * xpixels * ypixels
+    return max(1, int(budget // (bytes_per_pixel * xpixels * ypixels)))
+
+def gif_duration(seconds, frames):
+    if seconds is not None and seconds > 0:
+        return seconds * 1000 / frames
+    return 50
+
+def palette_image(index, lut):
+    # the same image as lut[index], but as a palette image (which gifs are made of) so it doesn't need quantizing.
+    # falls back to the RGBA image if there are too many colors for a gif's 256
+    if len(lut) > 256 and index.max() >= 256:
+        return Image.fromarray(np.take(lut, index, axis=0), 'RGBA')
+    im = Image.fromarray(np.ascontiguousarray(index, dtype=np.uint8), 'P')
+    im.putpalette(lut[:256, :3].tobytes())
+    return im
+
+def _pack(im):
+    # each pixel's RGB color as one number (red in the lowest byte)
+    return np.asarray(im.convert('RGBX')).view(np.dtype('<u4'))[..., 0] & 0xFFFFFF
+
+class GifWriter:
+    # writes an animated gif one frame at a time, so the frames don't all have to be kept in memory.
+    # palette images with the same palette as the first frame just use the gif's global color table;
+    # anything else gets its own. Quantized frames always get their own, since set_palette can change the global one
+    def __init__(self, path, duration=50):
+        self.path = path
+        self.duration = duration
+        self.file = None
+        self.palette = None
+
+    def append(self, im):
+        quantized = im.mode != 'P'
+        if quantized:
+            im = im.convert('P', palette=Image.ADAPTIVE)
+        if self.file is None:
+            self.file = open(self.path, 'wb')
+            header, _ = GifImagePlugin.getheader(im, info={'loop': 0})
+            for chunk in header:
+                self.file.write(chunk)
+            self.palette = im.getpalette()
+        local = quantized or im.getpalette() != self.palette
+        for chunk in GifImagePlugin.getdata(im, duration=self.duration, disposal=2, include_color_table=local):
+            self.file.write(chunk)
+
+    def set_palette(self, palette):
+        # rewrites the global color table of a gif that's already started (e.g. when later frames bring new colors),
+        # which has to stay the same size
+        if len(palette) != len(self.palette):
+            raise ValueError(f'Palette must have {len(self.palette)} entries, but had {len(palette)}')
+        position = self.file.tell()
+        self.file.seek(GIF_PALETTE_OFFSET)
+        self.file.write(bytes(palette))
+        self.file.seek(position)
+        self.palette = list(palette)
+
+    def close(self):
+        if self.file is not None:
+            self.file.write(b';')
+            self.file.close()
+            self.file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def save_gif(images, path, seconds=-1):
+    with GifWriter(path, duration=gif_duration(seconds, len(images))) as gif:
+        for im in images:
+            gif.append(im)
 
 def gif_folder(folder, filename='fractal_animated.gif', seconds=0):
+    # streams the frames from disk, so only one is in memory at a time
     if not os.path.isdir(folder):
         folder = relative('output', folder)
-    images = []
     pngs = sorted(filter(lambda fn: os.path.splitext(fn)[1] == '.png', os.listdir(folder)))
-    for fn in pngs:
-        im = Image.open(os.path.join(folder, fn))
-        images.append(im.convert('P', palette=Image.ADAPTIVE)) 
-    save_gif(images, os.path.join(folder, filename), seconds=seconds)
- 
\ No newline at end of file
+    paths = [os.path.join(folder, fn) for fn in pngs]
+    if len(paths) == 0:
+        raise ValueError(f'No pngs found in {folder}')
+    # every color gets a slot in one palette the first time it turns up, and the gif's global color table is
+    # updated to match, so frames are mapped to it exactly without going over them twice
+    colors = {}
+    table = np.zeros((256, 3), dtype=np.uint8)
+    lookup = np.zeros(1 << 24, dtype=np.uint8)
+    with GifWriter(os.path.join(folder, filename), duration=gif_duration(seconds, len(paths))) as gif:
+        for path in paths:
+            with Image.open(path) as im:
+                rgb = im.convert('RGB')
+            found = rgb.getcolors(256)
+            new = [] if found is None else [color for _, color in found if color not in colors]
+            if found is None or len(colors) + len(new) > 256:
+                # more colors than a gif can hold (which nothing from image() has), so it's quantized on its own
+                gif.append(rgb)
+                continue
+            for color in new:
+                table[len(colors)] = color
+                lookup[color[0] | color[1] << 8 | color[2] << 16] = len(colors)
+                colors[color] = len(colors)
+            if new and gif.file is not None:
+                gif.set_palette(table.tobytes())
+            gif.append(palette_image(lookup[_pack(rgb)], table))
@@ -2,11 +2,18 @@ import numpy as np
 import os
 import shutil
 import random
-from fractal import Fractal, gif_folder, relative
+from fractal import (BYTES_PER_PIXEL, COMPACT_BYTES_PER_PIXEL, Fractal, GifWriter, frames_per_batch, gif_duration,
+                     gif_folder, per_frame, relative)
+from parallel import default_workers, iterate_parallel
+from deepzoom import ORBIT_BYTES_PER_PIXEL, DeepFractal, load_decimal_complex
+from cache import cache_key, load_cached, store_cached
+from checkpoint import iterate_in_chunks, load_checkpoint, read_checkpoints, save_checkpoint
+from profiling import Profile
 from datetime import datetime
 import matplotlib.pyplot as plt
 from yaml import safe_load
 import argparse
+import tracemalloc
 
 def configs(filename):
     return os.path.join('configs', filename)
@@ -44,7 +51,7 @@ def randomize_config(filename='random.yaml'):
 
 
 
-def run_config(cfg: dict):
+def run_config(cfg: dict, resume: bool = False, show: bool = True, hooks: list = None):
     start = datetime.now()
     run_type = cfg.get('run_type', 'julia')
     if run_type == 'reanimate':
@@ -52,6 +59,19 @@ def run_config(cfg: dict):
         seconds = cfg.get('seconds', None)
         gif_folder(folder=folder, seconds=seconds)
         return
+    if run_type == 'resume':
+        # carries on from the checkpoints in folder, using the config they were saved with
+        # except for any other keys given here (e.g. more steps, or a different colormap)
+        meta = read_checkpoints(cfg['folder'])
+        if meta is None:
+            raise ValueError(f'No checkpoints found in {cfg["folder"]}')
+        resumed = dict(meta['config'])
+        if any(key in cfg for key in ['steps', 'steps_start', 'steps_end']):
+            for key in ['steps', 'steps_start', 'steps_end']:
+                resumed.pop(key, None)
+        resumed.update({key: value for key, value in cfg.items() if key != 'run_type'})
+        run_config(resumed, resume=True, show=show, hooks=hooks)
+        return
     pixels = cfg.get('pixels', 1024)
     xpixels = cfg.get('xpixels', pixels)
     ypixels = cfg.get('ypixels', pixels)
@@ -99,6 +119,71 @@ def run_config(cfg: dict):
     width = cfg.get('width', height * aspect_ratio)
     center = load_complex(cfg.get('center', 0))
     point_value_max = cfg.get('point_value_max', 2)
+    iterate_mode = cfg.get('iterate_mode', 'full')
+    if iterate_mode not in ['full', 'compact', 'wrapping']:
+        raise ValueError(f'Iterate mode must be either full, compact or wrapping, but was: {iterate_mode}')
+    checkpoint_interval = cfg.get('checkpoint_interval', None)
+    if checkpoint_interval is not None and (not isinstance(checkpoint_interval, int) or checkpoint_interval < 1):
+        raise ValueError(f'checkpoint_interval must be a positive integer, but was: {checkpoint_interval}')
+    checkpoint = resume or checkpoint_interval is not None or cfg.get('checkpoint', False)
+    render_mode = cfg.get('render_mode', 'direct')
+    antialias = cfg.get('antialias', 1)
+    if not isinstance(antialias, int) or antialias < 1:
+        raise ValueError(f'antialias must be a positive integer, but was: {antialias}')
+    if antialias > 1:
+        if color_by not in ['iterations', 'diverged']:
+            raise ValueError(f'antialias only blends iterations, so it can\'t color by {color_by}')
+        if iterate_mode == 'wrapping':
+            raise ValueError('antialias can\'t be used with iterate_mode wrapping, whose iterations aren\'t step counts')
+    interior_check = cfg.get('interior_check', False)
+    if render_mode == 'subdivide':
+        if color_by in ['value', 'undiverged', 'nested']:
+            raise ValueError(f'render_mode subdivide only fills in iterations, so it can\'t color by {color_by}')
+        min_tile = cfg.get('min_tile', 16)
+        if min_tile < 4:
+            raise ValueError(f'min_tile must be at least 4, but was: {min_tile}')
+        method = 'iterate_subdivide'
+        iterate_kwargs = dict(min_size=min_tile, interior=interior_check)
+    elif render_mode == 'direct':
+        if interior_check and iterate_mode != 'compact':
+            raise ValueError('interior_check requires iterate_mode: compact or render_mode: subdivide')
+        if iterate_mode == 'compact':
+            method = 'iterate_compact'
+            # the cardioid shortcut gets iterations right but not the values of the points it skips
+            iterate_kwargs = dict(interior=interior_check,
+                                  cardioid=interior_check and color_by not in ['value', 'undiverged', 'nested'])
+        elif iterate_mode == 'wrapping':
+            method = 'iterate_wrapping'
+            # checkpoints need points that haven't diverged left unfilled, so they're filled after saving
+            iterate_kwargs = dict(fill=not checkpoint)
+        else:
+            method = 'iterate'
+            iterate_kwargs = {}
+    else:
+        raise ValueError(f'Render mode must be either direct or subdivide, but was: {render_mode}')
+    workers = cfg.get('workers', 1)
+    if workers == 'auto':
+        workers = default_workers()
+    if not isinstance(workers, int) or workers < 1:
+        raise ValueError(f'Workers must be a positive integer or auto, but was: {workers}')
+    if checkpoint:
+        if run_type == 'deepzoom' or render_mode == 'subdivide':
+            raise ValueError('deepzoom and render_mode subdivide can\'t carry on from where they stopped, '
+                             'so they can\'t be checkpointed')
+        if checkpoint_interval is not None and workers > 1:
+            raise ValueError('checkpoint_interval can only be used with one worker')
+        if resume and workers > 1:
+            print('Resumed runs carry on in one process')
+            workers = 1
+    if run_type == 'deepzoom':
+        if render_mode != 'direct' or iterate_mode != 'full' or interior_check:
+            raise ValueError('deepzoom has its own engine, so it can\'t use render_mode, iterate_mode or interior_check')
+        if workers > 1:
+            raise ValueError('deepzoom can only run with one worker')
+        if not check(cfg, no=['shift', 'shift_start', 'shift_end']):
+            raise ValueError('deepzoom stays on its center, so it can\'t shift')
+        # the center keeps every digit it's written with, so quote it in the config to stop it being read as a float
+        deep_center = load_decimal_complex(cfg.get('center', 0))
     if check(cfg, has=['steps_start', 'steps_end'], no=['steps']):
         steps_start = cfg['steps_start']
         steps_end = cfg['steps_end']
@@ -111,11 +196,17 @@ def run_config(cfg: dict):
         folder_steps = steps
     else:
         raise ValueError('Config must have either steps_start+steps_end or steps, not both.')
+    if method == 'iterate_wrapping' and isinstance(steps, np.ndarray):
+        raise ValueError('iterate_mode wrapping needs a fixed number of steps')
 
     if check(cfg, has=['zoom_start', 'zoom_end'], no=['zoom']):
         zoom_start = cfg['zoom_start']
         zoom_end = cfg['zoom_end']
-        zscale = np.linspace(1 / zoom_start, 1 / zoom_end, frames)
+        if run_type == 'deepzoom':
+            # zooming in by the same factor every frame, since a linear zoom would spend almost every frame near the start
+            zscale = 1 / np.geomspace(zoom_start, zoom_end, frames)
+        else:
+            zscale = np.linspace(1 / zoom_start, 1 / zoom_end, frames)
     elif check(cfg, no=['zoom_start', 'zoom_end']):
         zoom = cfg.get('zoom', 1)
         zscale = np.full(frames, 1 / zoom)
@@ -196,30 +287,148 @@ def run_config(cfg: dict):
                      relative('output', 
                               start.strftime('%Y%m%d%H%M%S') + '_unknown'))
     os.makedirs(folder, exist_ok=True)
+    cache = cfg.get('cache', False)
+    if cache is True:
+        cache = relative('cache')
+    elif cache is not False and not isinstance(cache, str):
+        raise ValueError(f'Cache must be True, False, or a folder, but was: {cache}')
+    cache_size = cfg.get('cache_size', 4096)
+    hooks = list(hooks) if hooks is not None else []
+    profile = None
+    if cfg.get('profile', False):
+        profile = Profile()
+        hooks.append(profile)
+        # for the memory peak of each phase
+        tracing = tracemalloc.is_tracing()
+        if not tracing:
+            tracemalloc.start()
+    max_memory = cfg.get('max_memory', None)
+    if max_memory is None:
+        batch_frames = frames
+    else:
+        compact = method in ['iterate_compact', 'iterate_subdivide']
+        # deepzoom works on one frame at a time, but needs a lot of memory for it
+        working = ORBIT_BYTES_PER_PIXEL if run_type == 'deepzoom' else 0
+        batch_frames = min(frames, frames_per_batch(xpixels, ypixels, max_memory,
+                                                    COMPACT_BYTES_PER_PIXEL if compact else BYTES_PER_PIXEL, working))
+        # these scale their colors by the largest value over all the frames, which a batch can't know
+        if batch_frames < frames and (color_by in ['undiverged', 'nested']
+                                      or color_by == 'value' and normalize_frame_colors):
+            raise ValueError(f'color_by {color_by}{" with normalize_frame_colors" if color_by == "value" else ""} '
+                             f'scales colors over the whole animation, so it can\'t be split into batches by '
+                             f'max_memory ({batch_frames} of {frames} frames fit)')
+    gif = None
     try:
-        # print(power)
-        fractal = Fractal(xpixels, ypixels, 
-                    -width/2 + center.real, width/2 + center.real, -height/2 + center.imag, height/2 + center.imag,
-                    zadd=shift, zscale=zscale, 
-                    frames=frames)
-        if run_type == 'julia':
-            fractal.init_julia(power=power, param=param, valmax=point_value_max)
-        elif run_type == 'mandelbrot':
-            fractal.init_mandelbrot(power=power, valmax=point_value_max)
-        else:
-            raise ValueError(f'Run type must be either julia, mandelbrot, but was: {run_type}')
-        fractal.iterate(steps, log_interval=10)
-        fractal.show(color_by, normalize_frame_depths=normalize_frame_colors)
-        fractal.image(folder=folder, colormap=colormap, animate=frames > 1, seconds=seconds)
+        if batch_frames < frames:
+            # stream the animation: each batch of frames is saved and added to the gif before the next is started
+            gif = GifWriter(relative(folder, 'fractal_animated.gif'), duration=gif_duration(seconds, frames))
+        for first in range(0, frames, batch_frames):
+            last = min(first + batch_frames, frames)
+            if batch_frames < frames:
+                print(f'Frames {first}-{last - 1} of {frames}')
+            if run_type == 'deepzoom':
+                fractal = DeepFractal(xpixels, ypixels, deep_center, width, height,
+                                      zscale=per_frame(zscale, first, last), frames=last - first, hooks=hooks)
+            else:
+                fractal = Fractal(xpixels, ypixels, 
+                            -width/2 + center.real, width/2 + center.real, -height/2 + center.imag, height/2 + center.imag,
+                            zadd=per_frame(shift, first, last), zscale=per_frame(zscale, first, last), 
+                            frames=last - first, hooks=hooks)
+            if run_type == 'julia':
+                init_kwargs = dict(power=per_frame(power, first, last), param=per_frame(param, first, last),
+                                   valmax=point_value_max)
+                fractal.init_julia(**init_kwargs)
+            elif run_type in ['mandelbrot', 'deepzoom']:
+                init_kwargs = dict(power=per_frame(power, first, last), valmax=point_value_max)
+                fractal.init_mandelbrot(**init_kwargs)
+            else:
+                raise ValueError(f'Run type must be either julia, mandelbrot or deepzoom, but was: {run_type}')
+            batch_steps = per_frame(steps, first, last)
+            done = np.zeros(last - first, dtype=int)
+            if resume and (loaded := load_checkpoint(folder, first, fractal)) is not None:
+                done = loaded
+                batch_steps = np.broadcast_to(batch_steps, done.shape) - done
+                if (batch_steps < 0).any():
+                    raise ValueError('Can\'t resume with fewer steps than the checkpoint already has')
+                if np.all(batch_steps == batch_steps[0]):
+                    batch_steps = int(batch_steps[0])
+
+            def save(steps_done):
+                save_checkpoint(folder, cfg, first, fractal, done + steps_done)
+
+            key = None
+            if cache and not checkpoint:
+                key = cache_key(dict(run_type=run_type, shape=fractal.array.shape,
+                                     window=(fractal.xmin, fractal.xmax, fractal.ymin, fractal.ymax),
+                                     zadd=fractal.zadd, zscale=fractal.zscale, steps=batch_steps,
+                                     center=deep_center if run_type == 'deepzoom' else None,
+                                     method=method, iterate_kwargs=iterate_kwargs, **init_kwargs))
+            if key is not None and load_cached(cache, key, fractal):
+                print(f'Loaded from cache ({key[:12]})')
+            elif checkpoint_interval is not None:
+                iterate_in_chunks(fractal, method, batch_steps, checkpoint_interval, save, log_interval=10,
+                                  **iterate_kwargs)
+            else:
+                if run_type == 'deepzoom':
+                    run_method, run_kwargs = method, iterate_kwargs
+                elif method == 'iterate_wrapping':
+                    # frames that only differ in their steps (or not at all) are computed once
+                    run_method, run_kwargs = 'iterate_shared', dict(method=method, **iterate_kwargs)
+                else:
+                    # the same, and parts of the image that are mirror images of other parts are filled in
+                    run_method, run_kwargs = 'iterate_symmetric', dict(method=method, **iterate_kwargs)
+                if workers > 1:
+                    # the workers' own steps aren't reported, just the phase as a whole
+                    with fractal.instruments.phase('iterate'):
+                        iterate_parallel(fractal, run_type, init_kwargs, batch_steps, workers, method=run_method,
+                                         iterate_kwargs=run_kwargs, log_interval=10)
+                else:
+                    getattr(fractal, run_method)(batch_steps, log_interval=10, **run_kwargs)
+                if interior_check:
+                    print(f'{fractal.interior_count} points found to never diverge and stopped early')
+                if run_type == 'deepzoom':
+                    print(f'{fractal.rebased} rebases onto the start of the reference orbit')
+                if key is not None:
+                    store_cached(cache, key, fractal, cache_size)
+                if checkpoint:
+                    save(np.broadcast_to(batch_steps, done.shape))
+            if interior_check and checkpoint_interval is not None:
+                print(f'{fractal.interior_count} points found to never diverge and stopped early')
+            if checkpoint and method == 'iterate_wrapping':
+                fractal.iterate_wrapping(0)
+            # a batch only runs as many steps as its own frames need, but undiverged points
+            # should be judged against the steps of the whole run, the same as without batches
+            fractal.total_steps = int(folder_steps)
+            if antialias > 1:
+                fractal.antialias(per_frame(steps, first, last), samples=antialias)
+                print(f'{fractal.supersampled[0].size} of {fractal.iterations.size} pixels were on edges and supersampled')
+            fractal.show(color_by, normalize_frame_depths=normalize_frame_colors)
+            fractal.image(folder=folder, colormap=colormap, animate=frames > 1, seconds=seconds, gif=gif, first_frame=first,
+                          show=show)
+            del fractal
+        if gif is not None:
+            gif.close()
+        if profile is not None:
+            profile.write(folder)
+            print(f'Profile saved to {os.path.join(folder, "profile.json")} and profile.csv')
     except Exception as e:
+        if gif is not None:
+            gif.close()
         if len(os.listdir(folder)) == 0:
             shutil.rmtree(folder)
         raise e
+    finally:
+        if profile is not None and not tracing:
+            tracemalloc.stop()
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Generate either a Julia set or Mandelbrot variant.')
     parser.add_argument('YAML', nargs='?', default=None, help='path to a YAML config file, e.g. default.yaml')
     parser.add_argument('--random', '-r', action='store_true', help='generate a random config file')
+    parser.add_argument('--workers', '-w', default=None, help='number of processes to render with, or auto for one per core '
+                                                               '(overrides workers in the config)')
+    parser.add_argument('--profile', '-p', action='store_true', help='write a trace of how long each phase and step '
+                                                                     'took to the output folder')
     args = parser.parse_args()
     filename = args.YAML
     if args.random:
@@ -242,6 +451,10 @@ if __name__ == '__main__':
             filename = None
     with open(configs(filename), 'r') as file:
         cfg = safe_load(file)
+    if args.workers is not None:
+        cfg['workers'] = args.workers if args.workers == 'auto' else int(args.workers)
+    if args.profile:
+        cfg['profile'] = True
     if 'folder' not in cfg:
         folder_name = (datetime.now().strftime('%Y-%m-%d-%H%M%S') + ' ' + 
                        os.path.splitext(os.path.basename(filename))[0])
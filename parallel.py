@@ -0,0 +1,106 @@
+import numpy as np
+import os
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from collections import deque
+from multiprocessing import shared_memory
+from fractal import Fractal, per_frame
+
+def default_workers():
+    return os.cpu_count() or 1
+
+def split_tiles(frames, xpixels, workers):
+    # aim for a few tiles per worker so the ones that finish early can pick up more work.
+    # frames are split into batches first, then each batch is cut into strips along x
+    target = workers * 4
+    frame_batches = min(frames, target)
+    strips = min(xpixels, -(-target // frame_batches))
+    frame_edges = np.linspace(0, frames, frame_batches + 1).astype(int)
+    x_edges = np.linspace(0, xpixels, strips + 1).astype(int)
+    return [(int(f0), int(f1), int(x0), int(x1))
+            for f0, f1 in zip(frame_edges[:-1], frame_edges[1:])
+            for x0, x1 in zip(x_edges[:-1], x_edges[1:])]
+
+def _render_tile(tile, names, geometry, run_type, init_kwargs, steps, method, iterate_kwargs):
+    f0, f1, x0, x1 = tile
+    y0, y1 = geometry['yrange']
+    fractal = Fractal(geometry['xpixels'], geometry['ypixels'],
+                      geometry['xmin'], geometry['xmax'], geometry['ymin'], geometry['ymax'],
+                      zadd=per_frame(geometry['zadd'], f0, f1), zscale=per_frame(geometry['zscale'], f0, f1),
+                      frames=f1 - f0, xrange=(x0, x1), yrange=(y0, y1))
+    init_kwargs = {key: per_frame(value, f0, f1) for key, value in init_kwargs.items()}
+    if run_type == 'julia':
+        fractal.init_julia(**init_kwargs)
+    else:
+        fractal.init_mandelbrot(**init_kwargs)
+    getattr(fractal, method)(per_frame(steps, f0, f1), **iterate_kwargs)
+    for key, name in names.items():
+        values = getattr(fractal, key)
+        shm = shared_memory.SharedMemory(name=name)
+        np.ndarray(values.shape, dtype=values.dtype, buffer=shm.buf)[...] = values
+        shm.close()
+    return fractal.interior_count
+
+def iterate_parallel(fractal, run_type, init_kwargs, steps, workers, method='iterate', iterate_kwargs=None,
+                     log_interval=-1):
+    # fractal should be freshly initialized with the same run_type and init_kwargs; every worker regenerates its
+    # own tile of it and runs the iterate method (e.g. iterate_compact) on it, writing the results back through
+    # shared memory. With iterate_symmetric, only the part that isn't a mirror image is split into tiles,
+    # and the rest is filled in afterwards
+    if iterate_kwargs is None:
+        iterate_kwargs = {}
+    shape = fractal.array.shape
+    region, reflections = (0, shape[1], 0, shape[2]), []
+    if method == 'iterate_symmetric':
+        found = fractal.symmetry()
+        if found is not None:
+            region, reflections = found
+        method = 'iterate_shared'
+    x0, x1, y0, y1 = region
+    geometry = dict(xpixels=fractal.xpixels, ypixels=fractal.ypixels,
+                    xmin=fractal.xmin, xmax=fractal.xmax, ymin=fractal.ymin, ymax=fractal.ymax,
+                    zadd=fractal.zadd, zscale=fractal.zscale, yrange=(y0, y1))
+    if method == 'iterate_shared' and len(fractal.shared_frames()) < shape[0]:
+        # frames that share their work have to stay in the same tile, so tiles only split the image
+        tiles = [(0, shape[0], x0 + start, x0 + stop) for _, _, start, stop in split_tiles(1, x1 - x0, workers)]
+    else:
+        tiles = [(f0, f1, x0 + start, x0 + stop) for f0, f1, start, stop in split_tiles(shape[0], x1 - x0, workers)]
+    # each tile writes its results into a block of shared memory of its own, which is copied into fractal and freed
+    # as soon as the tile is done. Tiles are only handed out as workers free up, so there are never more blocks than
+    # workers, rather than a second copy of the whole fractal
+    queue = deque(tiles)
+    pending = {}
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            finished = 0
+            while queue or pending:
+                while queue and len(pending) < workers:
+                    tile = queue.popleft()
+                    f0, f1, t0, t1 = tile
+                    size = (f1 - f0) * (t1 - t0) * (y1 - y0)
+                    blocks = {key: shared_memory.SharedMemory(create=True,
+                                                              size=max(1, size * getattr(fractal, key).itemsize))
+                              for key in ['array', 'iterations']}
+                    names = {key: shm.name for key, shm in blocks.items()}
+                    future = pool.submit(_render_tile, tile, names, geometry, run_type, init_kwargs, steps, method,
+                                         iterate_kwargs)
+                    pending[future] = (tile, blocks)
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    fractal.interior_count += future.result()
+                    (f0, f1, t0, t1), blocks = pending.pop(future)
+                    for key, shm in blocks.items():
+                        target = getattr(fractal, key)[f0:f1, t0:t1, y0:y1]
+                        np.copyto(target, np.ndarray(target.shape, dtype=target.dtype, buffer=shm.buf))
+                        shm.close()
+                        shm.unlink()
+                    if log_interval > 0 and finished % log_interval == 0:
+                        print(f'{finished}/{len(tiles)} tiles')
+                    finished += 1
+        fractal.reflect(reflections)
+    finally:
+        for _, blocks in pending.values():
+            for shm in blocks.values():
+                shm.close()
+                shm.unlink()
+    fractal.total_steps += int(steps.max()) if isinstance(steps, np.ndarray) else steps
+    fractal.to_show = fractal.iterations
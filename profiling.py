@@ -0,0 +1,132 @@
+import csv
+import json
+import os
+import time
+import tracemalloc
+from contextlib import contextmanager
+from datetime import timedelta
+
+# columns of profile.csv, one row per event (fields an event doesn't have are left empty)
+TRACE_FIELDS = ['time', 'event', 'phase', 'step', 'steps', 'live', 'iterated', 'pixel_iterations', 'seconds',
+                'peak_bytes']
+
+class Instruments:
+    # what a Fractal reports to its hooks as it runs: a phase event as each phase (init, iterate, show, image, gif)
+    # ends, and a step event after every step of iterating. Each hook is called with the event as a dict.
+    # a fractal shares its instruments with the views it iterates through, so a phase inside another of the same name
+    # (like iterate_symmetric running iterate_compact) is part of it, and a phase inside a different one (like gif
+    # inside image) takes its time out of the outer one's seconds
+    def __init__(self, hooks=None):
+        self.hooks = list(hooks) if hooks is not None else []
+        self.pixel_iterations = 0
+        self.open = []
+
+    def emit(self, event, **info):
+        info = dict(event=event, **info)
+        for hook in self.hooks:
+            hook(info)
+
+    def _fold(self):
+        # the peak since the last phase started or ended was reached inside all the phases open now.
+        # only measured while tracemalloc is tracing, which is slow enough that it's left to whoever wants it
+        if tracemalloc.is_tracing():
+            peak = tracemalloc.get_traced_memory()[1]
+            for phase in self.open:
+                phase['peak_bytes'] = max(phase['peak_bytes'], peak)
+            tracemalloc.reset_peak()
+
+    @contextmanager
+    def phase(self, name, log_interval=-1):
+        # with log_interval, the progress of every iterating loop in the phase is printed that often (see progress_log)
+        if any(phase['phase'] == name for phase in self.open):
+            yield
+            return
+        self._fold()
+        now = time.perf_counter()
+        if self.open:
+            self.open[-1]['seconds'] += now - self.open[-1]['mark']
+        self.open.append(dict(phase=name, seconds=0.0, mark=now, peak_bytes=0))
+        log = progress_log(log_interval) if log_interval > 0 else None
+        if log is not None:
+            self.hooks.append(log)
+        try:
+            yield
+        finally:
+            if log is not None:
+                self.hooks.remove(log)
+            self._fold()
+            phase = self.open.pop()
+            now = time.perf_counter()
+            phase['seconds'] += now - phase['mark']
+            if self.open:
+                self.open[-1]['mark'] = now
+            self.emit('phase', phase=name, seconds=phase['seconds'],
+                      peak_bytes=phase['peak_bytes'] if tracemalloc.is_tracing() else None)
+
+    def steps(self, n):
+        # a function for a loop of n steps to call after each one with how many points are still going, and how many
+        # it iterated if that's different (e.g. iterate_wrapping keeps iterating diverged points).
+        # None if there are no hooks, so the loop doesn't need to count anything
+        if not self.hooks:
+            return None
+        last = time.perf_counter()
+
+        def step(ii, live, iterated=None):
+            nonlocal last
+            live = int(live)
+            iterated = live if iterated is None else int(iterated)
+            self.pixel_iterations += iterated
+            self.emit('step', phase=self.open[-1]['phase'] if self.open else None, step=ii + 1, steps=n, live=live,
+                      iterated=iterated, pixel_iterations=self.pixel_iterations,
+                      seconds=time.perf_counter() - last)
+            last = time.perf_counter()
+        return step
+
+def progress_log(interval):
+    # a hook that prints how far a loop has got every interval steps, with how long they took and how many points
+    # are still going
+    took = 0
+
+    def log(event):
+        nonlocal took
+        if event['event'] != 'step':
+            return
+        if event['step'] == 1:
+            took = 0
+        took += event['seconds']
+        if event['step'] % interval == 0:
+            print(f'{event["step"]}/{event["steps"]} (took {timedelta(seconds=took)}, {event["live"]} live)')
+            took = 0
+    return log
+
+class Profile:
+    # a hook that keeps every event along with when it happened, to write out as a trace
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.events = []
+
+    def __call__(self, event):
+        self.events.append(dict(event, time=time.perf_counter() - self.start))
+
+    def summary(self):
+        # the total time and highest memory peak of each phase, and the pixel-iterations done over the whole run
+        phases = {}
+        for event in self.events:
+            if event['event'] == 'phase':
+                total = phases.setdefault(event['phase'], dict(seconds=0.0, peak_bytes=None, count=0))
+                total['seconds'] += event['seconds']
+                total['count'] += 1
+                if event['peak_bytes'] is not None:
+                    total['peak_bytes'] = max(total['peak_bytes'] or 0, event['peak_bytes'])
+        steps = [event for event in self.events if event['event'] == 'step']
+        return dict(seconds=time.perf_counter() - self.start, phases=phases, steps=len(steps),
+                    pixel_iterations=sum(event['iterated'] for event in steps))
+
+    def write(self, folder):
+        # profile.json has the summary and every event, profile.csv has the events as a table
+        with open(os.path.join(folder, 'profile.json'), 'w') as file:
+            json.dump(dict(summary=self.summary(), events=self.events), file, indent=1, default=str)
+        with open(os.path.join(folder, 'profile.csv'), 'w', newline='') as file:
+            writer = csv.DictWriter(file, fieldnames=TRACE_FIELDS)
+            writer.writeheader()
+            writer.writerows(self.events)
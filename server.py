@@ -0,0 +1,362 @@
+import numpy as np
+import asyncio
+import heapq
+import io
+import json
+import os
+import argparse
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from decimal import Decimal, localcontext
+from urllib.parse import parse_qsl, urlsplit
+from PIL import Image
+import matplotlib.pyplot as plt
+from yaml import safe_load
+from fractal import Fractal, color_index, color_table, relative
+from deepzoom import DeepFractal, load_decimal_complex
+from parallel import default_workers
+from cache import cache_key
+from main import configs, load_complex
+
+# width and height of a tile in pixels, and of a quick preview of one
+TILE_PIXELS = 256
+PREVIEW_PIXELS = 64
+# deepest zoom level for complex64 tiles; past this their pixels start running into each other
+MAX_ZOOM = 16
+# from this zoom level on, Mandelbrot tiles with a whole power are rendered with deepzoom's engine instead,
+# which can go down to DEEP_MAX_ZOOM. The viewer keeps its position as float64 fractions of the whole map, which can
+# only place a pixel (2**-(z + 8) of the map) to a few bits past zoom level 44
+DEEP_ZOOM = 12
+DEEP_MAX_ZOOM = 44
+# how many zoom levels up to look for an already rendered tile to crop a preview from
+PREVIEW_LEVELS = 4
+# the order tiles waiting for a worker are rendered in
+PRIORITY_PREVIEW = 0
+PRIORITY_TILE = 1
+PRIORITY_PREFETCH = 2
+# settings the viewer can change per request, with the query string
+QUERY_KEYS = ['run_type', 'param', 'power', 'colormap', 'steps', 'steps_per_zoom']
+
+def first_value(cfg, key, default=None):
+    # key's value, or its first frame's if the config varies it over an animation (key_start to key_end)
+    if key in cfg:
+        return cfg[key]
+    return cfg.get(key + '_start', default)
+
+def load_settings(cfg):
+    # the tile settings from a config, using the same keys and defaults as main.py where they apply.
+    # settings that change over an animation start out at their first frame's value.
+    # zoom level 0 is one tile covering a height by height square around center
+    if any(key.startswith(('param_radius', 'param_degrees')) for key in cfg):
+        radius = first_value(cfg, 'param_radius')
+        degrees = first_value(cfg, 'param_degrees')
+        if radius is None or degrees is None:
+            raise ValueError('A param in polar coordinates needs both a radius (param_radius or param_radius_start) '
+                             'and an angle (param_degrees or param_degrees_start)')
+        param = radius * pow(np.e, complex(0, (degrees / 360) * 2 * np.pi))
+    else:
+        param = load_complex(first_value(cfg, 'param', -0.982+0.232j))
+    return dict(run_type=cfg.get('run_type', 'julia'), param=str(complex(param)), power=first_value(cfg, 'power', 2),
+                colormap=cfg.get('colormap', 'inferno'), steps=first_value(cfg, 'steps', 50),
+                steps_per_zoom=cfg.get('steps_per_zoom', 50), point_value_max=cfg.get('point_value_max', 2),
+                center=str(cfg.get('center', 0)), height=cfg.get('height', 3))
+
+def max_zoom(run_type, power):
+    if run_type == 'mandelbrot' and float(power).is_integer() and power >= 2:
+        return DEEP_MAX_ZOOM
+    return MAX_ZOOM
+
+def tile_spec(settings, query, z, x, y, pixels=TILE_PIXELS):
+    # everything a tile depends on, which is also what it's cached by
+    options = dict(settings)
+    options.update({key: value for key, value in query.items() if key in QUERY_KEYS})
+    run_type = options['run_type']
+    if run_type not in ['julia', 'mandelbrot']:
+        raise ValueError(f'Run type must be either julia or mandelbrot, but was: {run_type}')
+    power = float(options['power'])
+    if power.is_integer():
+        power = int(power)
+    if options['colormap'] not in plt.colormaps():
+        raise ValueError(f'Unknown colormap: {options["colormap"]}')
+    if not 0 <= z <= max_zoom(run_type, power) or not 0 <= x < 2 ** z or not 0 <= y < 2 ** z:
+        raise ValueError(f'No tile {z}/{x}/{y}')
+    steps = min(65535, int(float(options['steps']) + float(options['steps_per_zoom']) * z))
+    return dict(run_type=run_type, param=complex(load_complex(options['param'])) if run_type == 'julia' else None,
+                power=power, colormap=options['colormap'], steps=steps, valmax=float(options['point_value_max']),
+                center=options['center'], height=float(options['height']), z=z, x=x, y=y, pixels=pixels)
+
+def render_tile(spec):
+    # renders a tile (in a worker process) and returns it as png data. Pixels are at the centers of their squares,
+    # so neighboring tiles line up without repeating their edges
+    pixels = spec['pixels']
+    size = spec['height'] / 2 ** spec['z']
+    span = size - size / pixels
+    if spec['run_type'] == 'mandelbrot' and spec['z'] >= DEEP_ZOOM and isinstance(spec['power'], int):
+        real, imag = load_decimal_complex(spec['center'])
+        with localcontext() as ctx:
+            # exact, since size is a float divided by a power of 2
+            ctx.prec = 40 + 2 * spec['z']
+            dsize = Decimal(spec['height']) / 2 ** spec['z']
+            corner = (real - Decimal(spec['height']) / 2, imag + Decimal(spec['height']) / 2)
+            center = (corner[0] + (spec['x'] + Decimal('0.5')) * dsize,
+                      corner[1] - (spec['y'] + Decimal('0.5')) * dsize)
+        fractal = DeepFractal(pixels, pixels, center, span, span, zscale=np.ones(1))
+        fractal.init_mandelbrot(power=spec['power'], valmax=spec['valmax'])
+        fractal.iterate(spec['steps'])
+    else:
+        center = load_complex(spec['center'])
+        xmin = center.real - spec['height'] / 2 + spec['x'] * size + size / pixels / 2
+        ymax = center.imag + spec['height'] / 2 - spec['y'] * size - size / pixels / 2
+        fractal = Fractal(pixels, pixels, xmin, xmin + span, ymax - span, ymax, zscale=np.ones(1))
+        if spec['run_type'] == 'julia':
+            fractal.init_julia(power=spec['power'], param=spec['param'], valmax=spec['valmax'])
+        else:
+            fractal.init_mandelbrot(power=spec['power'], valmax=spec['valmax'])
+        fractal.iterate_symmetric(spec['steps'], method='iterate_compact', interior=True, cardioid=True)
+    # colored by iterations out of the tile's steps, so the colors match between tiles
+    lut = color_table(plt.get_cmap(spec['colormap']))
+    scaled = fractal.iterations[0] / max(spec['steps'], 1)
+    index = color_index(scaled, len(lut) - 1).T[::-1]
+    return _png(Image.fromarray(np.take(lut, index, axis=0), 'RGBA'))
+
+def _png(im):
+    data = io.BytesIO()
+    im.save(data, 'PNG')
+    return data.getvalue()
+
+class TileCache:
+    # rendered tiles by key, the most recent memory_tiles of them in memory and up to max_size megabytes of them
+    # in folder, both dropping the least recently used first
+    def __init__(self, folder, memory_tiles=1024, max_size=1024):
+        self.folder = folder
+        self.memory_tiles = memory_tiles
+        self.max_size = max_size
+        self.memory = OrderedDict()
+        os.makedirs(folder, exist_ok=True)
+        self.disk_size = sum(entry.stat().st_size for entry in os.scandir(folder) if entry.is_file())
+
+    def _path(self, key):
+        return os.path.join(self.folder, key + '.png')
+
+    def __contains__(self, key):
+        return key in self.memory or os.path.exists(self._path(key))
+
+    def _remember(self, key, data):
+        self.memory[key] = data
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.memory_tiles:
+            self.memory.popitem(last=False)
+
+    def get(self, key):
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            return self.memory[key]
+        try:
+            with open(self._path(key), 'rb') as file:
+                data = file.read()
+            os.utime(self._path(key))  # marks it as recently used
+        except FileNotFoundError:
+            return None
+        self._remember(key, data)
+        return data
+
+    def put(self, key, data):
+        self._remember(key, data)
+        staging = self._path(key) + '.tmp'
+        with open(staging, 'wb') as file:
+            file.write(data)
+        os.replace(staging, self._path(key))
+        self.disk_size += len(data)
+        if self.disk_size > self.max_size * 2 ** 20:
+            self.evict()
+
+    def evict(self):
+        # down to 90% of max_size, so this doesn't have to run again for every tile
+        entries = sorted((entry.stat().st_mtime, entry.stat().st_size, entry.path)
+                         for entry in os.scandir(self.folder) if entry.is_file())
+        self.disk_size = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if self.disk_size <= self.max_size * 2 ** 20 * 0.9:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self.disk_size -= size
+
+class TileServer:
+    def __init__(self, settings, workers, cache):
+        self.settings = settings
+        self.workers = workers
+        self.cache = cache
+        self.pool = ProcessPoolExecutor(max_workers=workers)
+        # futures for the tiles that have been asked for but aren't done, so each one is only rendered once
+        self.pending = {}
+        # (priority, order, key, spec) for the tiles waiting for a worker, lowest first. Only as many tiles as there
+        # are workers are handed to the pool at once, so the ones asked for later can still go ahead of prefetches
+        self.waiting = []
+        self.started = set()
+        self.order = 0
+
+    def render(self, spec, priority=PRIORITY_TILE):
+        key = cache_key(spec)
+        if key not in self.pending:
+            self.pending[key] = asyncio.get_running_loop().create_future()
+        if key not in self.started:
+            # if it was already waiting with a lower priority, this entry gets to it first
+            heapq.heappush(self.waiting, (priority, self.order, key, spec))
+            self.order += 1
+            self._dispatch()
+        return self.pending[key]
+
+    def _dispatch(self):
+        while self.waiting and len(self.started) < self.workers:
+            _, _, key, spec = heapq.heappop(self.waiting)
+            if key in self.started or key not in self.pending:
+                continue
+            self.started.add(key)
+            job = asyncio.get_running_loop().run_in_executor(self.pool, render_tile, spec)
+            job.add_done_callback(lambda done, key=key: self._rendered(key, done))
+
+    def _rendered(self, key, job):
+        self.started.discard(key)
+        future = self.pending.pop(key)
+        if job.cancelled():
+            future.cancel()
+        elif job.exception() is not None:
+            future.set_exception(job.exception())
+        else:
+            self.cache.put(key, job.result())
+            future.set_result(job.result())
+        self._dispatch()
+
+    async def tile(self, spec):
+        data = self.cache.get(cache_key(spec))
+        if data is None:
+            # shielded, so a browser dropping the request (e.g. the tile was panned away) doesn't cancel it
+            data = await asyncio.shield(self.render(spec))
+        self.prefetch(spec)
+        return data
+
+    def prefetch(self, spec):
+        # queues up the neighboring tiles (behind any tiles actually asked for), unless there's plenty queued already
+        for dx, dy in [(1, 0), (-1, 0), (0, 1), (0, -1), (1, 1), (-1, -1), (1, -1), (-1, 1)]:
+            if len(self.pending) >= self.workers * 2:
+                return
+            x, y = spec['x'] + dx, spec['y'] + dy
+            if 0 <= x < 2 ** spec['z'] and 0 <= y < 2 ** spec['z']:
+                neighbor = dict(spec, x=x, y=y)
+                if cache_key(neighbor) not in self.cache:
+                    self.render(neighbor, priority=PRIORITY_PREFETCH)
+
+    async def preview(self, query, z, x, y):
+        # a rough version of a tile to show while it renders: part of a tile a few zoom levels up if one's already
+        # been rendered, or else the tile rendered with fewer pixels
+        for up in range(1, min(z, PREVIEW_LEVELS) + 1):
+            data = self.cache.get(cache_key(tile_spec(self.settings, query, z - up, x >> up, y >> up)))
+            if data is not None:
+                part = TILE_PIXELS >> up
+                left = (x - (x >> up << up)) * part
+                top = (y - (y >> up << up)) * part
+                with Image.open(io.BytesIO(data)) as im:
+                    return _png(im.crop((left, top, left + part, top + part)))
+        spec = tile_spec(self.settings, query, z, x, y, pixels=PREVIEW_PIXELS)
+        data = self.cache.get(cache_key(spec))
+        if data is None:
+            data = await asyncio.shield(self.render(spec, priority=PRIORITY_PREVIEW))
+        return data
+
+    async def respond(self, path, query):
+        parts = path.strip('/').split('/')
+        if path == '/':
+            with open(relative('viewer.html'), 'rb') as file:
+                return 200, 'text/html; charset=utf-8', file.read()
+        if path == '/settings.json':
+            settings = dict(self.settings)
+            settings.update({key: value for key, value in query.items() if key in QUERY_KEYS})
+            try:
+                settings.update(max_zoom=max_zoom(settings['run_type'], float(settings['power'])),
+                                tile_pixels=TILE_PIXELS)
+            except ValueError as e:
+                return 400, 'text/plain', str(e).encode()
+            return 200, 'application/json', json.dumps(settings).encode()
+        if len(parts) == 4 and parts[0] in ['tile', 'preview'] and parts[3].endswith('.png'):
+            try:
+                z, x, y = int(parts[1]), int(parts[2]), int(parts[3][:-4])
+                if parts[0] == 'tile':
+                    data = await self.tile(tile_spec(self.settings, query, z, x, y))
+                else:
+                    data = await self.preview(query, z, x, y)
+            except ValueError as e:
+                return 400, 'text/plain', str(e).encode()
+            return 200, 'image/png', data
+        return 404, 'text/plain', b'Not found'
+
+    async def handle(self, reader, writer):
+        # just enough HTTP/1.1 for a browser on the same machine: GET requests, kept alive between tiles
+        try:
+            while True:
+                request = await reader.readline()
+                if not request:
+                    break
+                method, target, _ = request.decode('latin-1').split(' ', 2)
+                headers = {}
+                while (line := await reader.readline()) not in [b'\r\n', b'\n', b'']:
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                url = urlsplit(target)
+                if method != 'GET':
+                    status, content_type, body = 405, 'text/plain', b'Only GET is supported'
+                else:
+                    try:
+                        status, content_type, body = await self.respond(url.path, dict(parse_qsl(url.query)))
+                    except Exception as e:
+                        print(f'Error serving {target}: {e!r}')
+                        status, content_type, body = 500, 'text/plain', repr(e).encode()
+                reason = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+                          500: 'Internal Server Error'}[status]
+                writer.write(f'HTTP/1.1 {status} {reason}\r\nContent-Type: {content_type}\r\n'
+                             f'Content-Length: {len(body)}\r\nCache-Control: no-cache\r\n\r\n'.encode() + body)
+                await writer.drain()
+                if headers.get('connection', '').lower() == 'close':
+                    break
+        except (ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+async def serve(settings, port=8000, workers=1, cache=None):
+    server = TileServer(settings, workers, cache)
+    # only ever listens on this machine
+    listener = await asyncio.start_server(server.handle, '127.0.0.1', port)
+    print(f'Serving on http://127.0.0.1:{port}/ with {workers} worker{"s" if workers > 1 else ""}')
+    try:
+        async with listener:
+            await listener.serve_forever()
+    finally:
+        server.pool.shutdown(cancel_futures=True)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve fractal tiles to explore in a browser.')
+    parser.add_argument('YAML', nargs='?', default=None, help='path to a YAML config file to start from, e.g. default.yaml')
+    parser.add_argument('--port', '-p', type=int, default=8000, help='port to listen on (on 127.0.0.1)')
+    parser.add_argument('--workers', '-w', default=None, help='number of processes to render with, or auto for one per core '
+                                                               '(defaults to auto)')
+    args = parser.parse_args()
+    cfg = {}
+    if args.YAML is not None:
+        filename = args.YAML
+        for path in [filename, configs(filename), configs(filename + '.yaml')]:
+            if os.path.exists(path):
+                with open(path, 'r') as file:
+                    cfg = safe_load(file)
+                break
+        else:
+            raise FileNotFoundError(f'File not found: {filename}')
+    workers = default_workers() if args.workers in [None, 'auto'] else int(args.workers)
+    cache = TileCache(cfg.get('tile_cache', relative('tile_cache')), memory_tiles=cfg.get('tile_memory', 1024),
+                      max_size=cfg.get('tile_cache_size', 1024))
+    try:
+        asyncio.run(serve(load_settings(cfg), port=args.port, workers=workers, cache=cache))
+    except KeyboardInterrupt:
+        pass